@@ -2,16 +2,29 @@
 Fetch SHA-1 password hashes from the pwnedpasswords.com API.
 """
 
+from __future__ import annotations
+
+import asyncio
+import binascii
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import logging
 import random
 import time
-from types import NotImplementedType
-from typing import TypeAlias
+from typing import Optional, TYPE_CHECKING, TypeAlias
+
+import httpx
 
-import requests
+from .cache import RangeCache
 
+if TYPE_CHECKING:
+    import aiohttp
 
-HashCounts: TypeAlias = list[tuple[str, int]]
+
+HashCounts: TypeAlias = list[tuple[bytes, int]]
+Range: TypeAlias = tuple[Optional[HashCounts], Optional[str]]
+FrozenHashCounts: TypeAlias = tuple[tuple[bytes, int], ...]
+CachedRange: TypeAlias = tuple[FrozenHashCounts, Optional[str], float]
 logger = logging.getLogger(__name__)
 
 
@@ -24,6 +37,7 @@ class Prefix:
         This was written first to abstract away operationial details, before
         the database layer was written.
     """
+    __slots__ = ('_prefix',)
     MAX_VALUE = 16**5 - 1               # Five hexadecimal characters, plus zero
 
     def __init__(self, prefix: str):
@@ -44,7 +58,7 @@ class Prefix:
 
         self._prefix = prefix
 
-    def __eq__(self, other: object) -> bool | NotImplementedType:
+    def __eq__(self, other: object) -> bool:
         if not isinstance(other, Prefix):
             return NotImplemented
         return self._prefix == other._prefix
@@ -68,102 +82,464 @@ class Prefix:
             raise ValueError('value must be a positive integer')
         if value > Prefix.MAX_VALUE:
             raise ValueError('value cannot be greater than MAX_VALUE')
-        return cls(f"{value:0>5x}")
+        return cls._unsafe_new(f"{value:0>5x}")
+
+    @classmethod
+    def _unsafe_new(cls, prefix: str) -> 'Prefix':
+        """
+        Create instance from a string already known to be a valid prefix.
+
+        Skips all of the cleaning and validation done by the initialiser, so
+        only use for internally generated strings, eg. from `from_integer()`.
+        """
+        instance = cls.__new__(cls)
+        instance._prefix = prefix
+        return instance
 
     @staticmethod
     def random() -> 'Prefix':
-        value = random.randint(0, Prefix.MAX_VALUE)
-        return Prefix.from_integer(value)
+        # MAX_VALUE is all ones, so every 20-bit value is a valid prefix
+        value = random.getrandbits(20)
+        return Prefix._unsafe_new(f"{value:0>5x}")
 
 
-class PwnedPasswordsAPIv3:
+def parse_range(body: bytes, prefix: str) -> HashCounts:
+    """
+    Parse the body of a range response into full hashes and their counts.
+
+    A plain function of its arguments, so that it may be run in another
+    process, or swapped for a compiled implementation.
+
+    The body is parsed as bytes, without ever being decoded to text. The API
+    gives suffixes in upper-case, but there's no need to normalise them:
+    `binascii.unhexlify()` accepts either case, so each line costs just the
+    one concatenation with the prefix. Plain `split()` calls measured faster
+    than either a compiled regex or fixed-width slicing, and unlike a regex
+    they can't skip over malformed lines.
+
+    Args:
+        body:
+            Raw response body from API, each line a hash suffix and a count.
+        prefix:
+            Lower-case, five-character hexadecimal prefix of the range.
+
+    Raises:
+        RuntimeError:
+            If any line of the body is malformed.
+
+    Returns:
+        List of 2-tuples, raw 20-byte hash and integer counts.
+    """
+    data: HashCounts = []
+    head = prefix.encode('ascii')
+    unhexlify = binascii.unhexlify
+    try:
+        for line in body.split():
+            suffix, count = line.split(b':')
+            data.append((unhexlify(head + suffix), int(count)))
+    except ValueError as e:
+        e = _text_error(line, prefix, e)
+        raise RuntimeError(f"line {len(data) + 1}: {e}") from None
+    return data
+
+
+def _text_error(line: bytes, prefix: str, error: ValueError) -> ValueError:
+    """
+    Parse malformed line again as text, so that its error shows no bytes reprs.
+
+    Args:
+        line:
+            Line from range body that failed to parse.
+        prefix:
+            Lower-case, five-character hexadecimal prefix of the range.
+        error:
+            Error raised while parsing line as bytes.
+
+    Returns:
+        Same error, but raised by parsing the decoded line instead.
+    """
+    text = line.decode('ascii', 'replace')
+    try:
+        suffix, count = text.split(':')
+        binascii.unhexlify(prefix + suffix)
+        int(count)
+    except ValueError as e:
+        return e
+    return error
+
+
+class _PwnedPasswordsAPI:
+    """
+    Parts common to both the blocking and asynchronous API clients.
+    """
+    URL_RANGE = 'https://api.pwnedpasswords.com/range'
+
+    def __init__(self, *, timeout: float):
+        self.timeout = timeout
+
+        # Accounting. Bytes counts request/response body data only.
+        self.bytes_received = 0
+        self.num_requests = 0
+        self.num_request_errors = 0
+
+    def _build_url(self, prefix: Prefix | str) -> tuple[Prefix, str]:
+        """
+        Build URL to range endpoint for the given prefix.
+
+        Args:
+            prefix:
+                Five-character hexadecimal prefix.
+
+        Returns:
+            Validated prefix object, and the full URL for its range.
+        """
+        if not isinstance(prefix, Prefix):
+            prefix = Prefix(prefix)
+        url = f"{self.URL_RANGE}/{prefix}"
+        return prefix, url
+
+    def _build_headers(self, etag: Optional[str]) -> dict[str, str]:
+        """
+        Build request headers, making request conditional if we have an ETag.
+        """
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        return headers
+
+    def _extract(self, prefix: Prefix, content: bytes) -> HashCounts:
+        """
+        Args:
+            prefix:
+                Five-character hexadecimal prefix.
+            content:
+                Raw response body from API.
+
+        Returns:
+            List of 2-tuples, raw 20-byte hash and integer counts.
+        """
+        return parse_range(content, str(prefix))
+
+
+class PwnedPasswordsAPIv3(_PwnedPasswordsAPI):
     """
     Download password hashes from Pwned Passwords API v3.
 
     See:
         https://haveibeenpwned.com/
     """
-    URL_RANGE = 'https://api.pwnedpasswords.com/range'
-
-    def __init__(self, *, timeout: float = 5.0):
+    def __init__(
+        self,
+        *,
+        cache: Optional[RangeCache] = None,
+        cache_size: int = 4096,
+        timeout: float = 5.0,
+    ):
         """
         Initialiser.
 
         Args:
+            cache:
+                Optional on-disk cache, used by `fetch_range_cached()`.
+            cache_size:
+                Maximum number of ranges `fetch_range_cached()` will keep
+                in memory. They go stale after the on-disk cache's `max_age`,
+                or `RangeCache.MAX_AGE` if there isn't one.
             timeout:
                 Optionally override the number of seconds we'll wait for a
                 server to respond before abandoning request.
         """
-        # Core fields
-        self.session = requests.session()
-        self.timeout = timeout
+        super().__init__(timeout=timeout)
+        self.cache = cache
+        self.cache_size = cache_size
+        self.max_age = RangeCache.MAX_AGE if cache is None else cache.max_age
 
-        # Accounting. Bytes counts request/response body data only.
-        self.bytes_received = 0
-        self.num_requests = 0
-        self.num_request_errors = 0
+        # Least-recently used first. Values are hashes, ETag, and timestamp.
+        self._memory: OrderedDict[str, CachedRange] = OrderedDict()
+        self.session: Optional[httpx.Client] = None
 
-    def fetch_range(self, prefix: Prefix | str) -> HashCounts:
+    def close(self) -> None:
+        """
+        Close underlying HTTP client, if it was ever started.
+        """
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def fetch_range(self, prefix: Prefix | str, etag: Optional[str] = None) -> Range:
         """
         Fetch password hashes and their counts.
 
         Args:
             prefix:
                 Five-character hexadecimal prefix.
+            etag:
+                ETag from a previous fetch of the same prefix, if known.
 
         Returns:
-            List of 2-tuples, each containing hash then count.
+            2-tuple of hashes and the range's current ETag. The hashes are a
+            list of 2-tuples, each containing hash then count - or None if the
+            range has not been modified since `etag` was given out.
         """
-        if not isinstance(prefix, Prefix):
-            prefix = Prefix(prefix)
-        url = f"{self.URL_RANGE}/{prefix}"
-        string = self._get(url)
-        data = self._extract(prefix, string)
-        return data
-
-    def _extract(self, prefix: Prefix, string: str) -> HashCounts:
+        prefix, url = self._build_url(prefix)
+        content, etag = self._get(url, etag)
+        if content is None:
+            return None, etag
+        data = self._extract(prefix, content)
+        return data, etag
+
+    def fetch_range_cached(self, prefix: Prefix | str) -> FrozenHashCounts:
         """
+        Fetch password hashes and their counts, avoiding the API where possible.
+
+        The most recently used ranges are kept in memory. Below that, if we
+        have an on-disk cache, its fresh entries are used as-is. Stale entries,
+        from either, are revalidated by making a conditional request using
+        their ETag, and replaced only if the API's ETag no longer matches.
+
         Args:
             prefix:
                 Five-character hexadecimal prefix.
-            string:
-                Multiline string from API.
 
         Returns:
-            List of 2-tuples, hash string and integer counts.
+            Tuple of 2-tuples, each containing hash then count.
         """
-        data: HashCounts = []
-        for number, line in enumerate(string.split(), 1):
-            try:
-                suffix, count = line.split(':')
-                sha1sum = f"{prefix}{suffix}".casefold()
-                datum = (sha1sum, int(count))
-                data.append(datum)
-            except ValueError as e:
-                raise RuntimeError(f"line {number}: {e}") from None
-        return data
+        validated, url = self._build_url(prefix)
+        prefix = str(validated)
+        entry = self._memory.pop(prefix, None)
+        if entry is None or time.time() - entry[2] >= self.max_age:
+            entry = self._fetch_range_uncached(prefix, url, entry)
+
+        self._memory[prefix] = entry
+        if len(self._memory) > self.cache_size:
+            self._memory.popitem(last=False)
+        return entry[0]
+
+    def _fetch_range_uncached(
+        self,
+        prefix: str,
+        url: str,
+        stale: Optional[CachedRange],
+    ) -> CachedRange:
+        """
+        Fetch range from the on-disk cache if we can, otherwise from the API.
+
+        Args:
+            prefix:
+                Lower-case, five-character hexadecimal prefix.
+            url:
+                Full URL for its range.
+            stale:
+                Stale range from memory, if any, to revalidate if not on disk.
 
-    def _get(self, url: str) -> str:
+        Returns:
+            Hashes, their ETag, and timestamp when they were last known fresh.
+        """
+        cached = None if self.cache is None else self.cache.get(prefix)
+        if cached is not None and self.cache is not None:
+            body, etag = cached
+            modified = self.cache.modified(prefix)
+            if modified is not None and self.cache.is_fresh(prefix):
+                return tuple(parse_range(body, prefix)), etag, modified
+
+            content, etag = self._get(url, etag)
+            if content is None:
+                self.cache.touch(prefix)
+                return tuple(parse_range(body, prefix)), etag, time.time()
+        elif stale is not None:
+            hashes, etag, _ = stale
+            content, etag = self._get(url, etag)
+            if content is None:
+                return hashes, etag, time.time()
+        else:
+            content, etag = self._get(url)
+            assert content is not None, "unconditional fetch cannot be 'not modified'"
+
+        if self.cache is not None:
+            self.cache.put(prefix, content, etag)
+        return tuple(parse_range(content, prefix)), etag, time.time()
+
+    def _get(
+        self,
+        url: str,
+        etag: Optional[str] = None,
+    ) -> tuple[Optional[bytes], Optional[str]]:
         """
         Fetch hash prefixes and their counts from API endpoint.
 
         Args:
             url:
                 Full URL to API endpoint.
+            etag:
+                Make request conditional on resource having changed.
 
         Returns:
-            Plain-text, multliline string
+            Raw response body - or None if not modified - and the response's
+            ETag header.
         """
+        if self.session is None:
+            self.session = self._create_session()
+
         # Request
         self.num_requests += 1
         start = time.perf_counter()
-        response = self.session.get(url)
+        response = self.session.get(url, headers=self._build_headers(etag))
+        etag = response.headers.get('ETag', etag)
+        if response.status_code == 304:
+            logger.debug("Not modified since %s at %s", etag, url)
+            return None, etag
         response.raise_for_status()
 
         # Log result
         self.bytes_received += len(response.content)
         logger.debug(
-            f"Fetched {len(response.content):,} bytes in "
-            f"{time.perf_counter() - start:.3f}s from {url}"
+            "Fetched %s bytes in %.3fs from %s",
+            len(response.content), time.perf_counter() - start, url,
         )
-        return response.text
+        return response.content, etag
+
+    def _create_session(self) -> httpx.Client:
+        """
+        Create HTTP client, only once we first need it.
+
+        Requests are made one at a time, so one HTTP/2 connection, kept alive
+        between them, is all we need. It saves a TCP and TLS handshake for
+        every prefix after the first.
+        """
+        limits = httpx.Limits(max_keepalive_connections=1, max_connections=1)
+        return httpx.Client(http2=True, limits=limits, timeout=self.timeout)
+
+
+class AsyncPwnedPasswordsAPIv3(_PwnedPasswordsAPI):
+    """
+    Download password hashes concurrently from Pwned Passwords API v3.
+
+    Many range requests may be awaited together, eg. via `asyncio.gather()`,
+    but no more than `max_requests` will be in-flight at any one time.
+
+    The `aiohttp` session is only created on first use, as it must be created
+    from within a running event loop. Call `close()` once finished with it.
+
+    Parsing range bodies is CPU-bound, so may be handed off to a pool of
+    worker processes, leaving the event loop free to keep the downloads
+    coming. Only the parsed hashes come back; nothing else leaves this process.
+    """
+    def __init__(self, *, max_requests: int = 64, timeout: float = 5.0, workers: int = 0):
+        """
+        Initialiser.
+
+        Args:
+            max_requests:
+                Maximum number of simultaneous requests to make to the API.
+            timeout:
+                Optionally override the number of seconds we'll wait for a
+                server to respond before abandoning request.
+            workers:
+                Number of processes to parse responses with. Zero, the
+                default, parses them in this process instead.
+        """
+        super().__init__(timeout=timeout)
+        self.max_requests = max_requests
+        self.semaphore = asyncio.Semaphore(max_requests)
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    async def close(self) -> None:
+        """
+        Close underlying HTTP session and worker processes, if started.
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def fetch_range(self, prefix: Prefix | str, etag: Optional[str] = None) -> Range:
+        """
+        Fetch password hashes and their counts.
+
+        Args:
+            prefix:
+                Five-character hexadecimal prefix.
+            etag:
+                ETag from a previous fetch of the same prefix, if known.
+
+        Returns:
+            2-tuple of hashes and the range's current ETag. The hashes are a
+            list of 2-tuples, each containing hash then count - or None if the
+            range has not been modified since `etag` was given out.
+        """
+        prefix, url = self._build_url(prefix)
+        content, etag = await self._get(url, etag)
+        if content is None:
+            return None, etag
+        if self.workers:
+            data = await self._extract_in_worker(prefix, content)
+        else:
+            data = self._extract(prefix, content)
+        return data, etag
+
+    async def _extract_in_worker(self, prefix: Prefix, content: bytes) -> HashCounts:
+        """
+        Parse range body in one of our worker processes, started on first use.
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, parse_range, content, str(prefix))
+
+    async def _get(
+        self,
+        url: str,
+        etag: Optional[str] = None,
+    ) -> tuple[Optional[bytes], Optional[str]]:
+        """
+        Fetch hash prefixes and their counts from API endpoint.
+
+        Args:
+            url:
+                Full URL to API endpoint.
+            etag:
+                Make request conditional on resource having changed.
+
+        Returns:
+            Raw response body - or None if not modified - and the response's
+            ETag header.
+        """
+        if self.session is None:
+            self.session = self._create_session()
+
+        async with self.semaphore:
+            # Request
+            self.num_requests += 1
+            start = time.perf_counter()
+            headers = self._build_headers(etag)
+            async with self.session.get(url, headers=headers) as response:
+                response.raise_for_status()
+                etag = response.headers.get('ETag', etag)
+                if response.status == 304:
+                    logger.debug("Not modified since %s at %s", etag, url)
+                    return None, etag
+                content = await response.read()
+
+        # Log result
+        self.bytes_received += len(content)
+        logger.debug(
+            "Fetched %s bytes in %.3fs from %s",
+            len(content), time.perf_counter() - start, url,
+        )
+        return content, etag
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        """
+        Create HTTP session, with connection pool sized to our request limit.
+
+        The `aiohttp` import is deferred until here, so that the blocking
+        client may be used without it.
+        """
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=self.max_requests, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
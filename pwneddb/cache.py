@@ -0,0 +1,129 @@
+"""
+Local, on-disk cache of range responses from the API.
+"""
+
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class RangeCache:
+    """
+    Keep the body of each range response in its own compressed file.
+
+    As with the API's own caching, entries are validated using their ETag.
+    The cache never decides for itself that an entry is wrong: a stale
+    entry is revalidated with a conditional request, and it's only replaced
+    if the API hands out a new body with a new ETag.
+
+    Each file holds the range's ETag on its first line (empty if the API
+    didn't give us one), followed by the response body, unchanged. Files are
+    compressed with Zstandard, which decompresses much faster than gzip.
+    """
+    LEVEL = 3
+    MAX_AGE = 24 * 60 * 60
+    SUFFIX = '.zst'
+
+    def __init__(self, folder: Path, *, max_age: float = MAX_AGE):
+        """
+        Initialiser.
+
+        Args:
+            folder:
+                Folder to keep cache files in. Created if it doesn't exist.
+            max_age:
+                Number of seconds after which an entry must be revalidated.
+        """
+        self.folder = folder
+        self.max_age = max_age
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        # Deferred until here, as its compiled backend can't be loaded from
+        # inside a zipapp. Only the cache itself needs it.
+        import zstandard
+        self._compressor = zstandard.ZstdCompressor(level=self.LEVEL)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def get(self, prefix: str) -> Optional[tuple[bytes, Optional[str]]]:
+        """
+        Read cached body for given prefix, whether fresh or not.
+
+        Args:
+            prefix:
+                Five-character hexadecimal prefix.
+
+        Returns:
+            Range response body and its ETag, or None if not cached.
+        """
+        path = self.path(prefix)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        etag, body = self._decode(data)
+        return body, etag
+
+    def is_fresh(self, prefix: str) -> bool:
+        """
+        Is there an entry for the prefix that doesn't yet need revalidating?
+        """
+        modified = self.modified(prefix)
+        if modified is None:
+            return False
+        return (time.time() - modified) < self.max_age
+
+    def modified(self, prefix: str) -> Optional[float]:
+        """
+        Timestamp when entry for prefix was last saved or revalidated.
+
+        Returns:
+            Timestamp, or None if not cached.
+        """
+        try:
+            return self.path(prefix).stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def path(self, prefix: str) -> Path:
+        """
+        Build path to cache file for given prefix.
+        """
+        return self.folder / f"{prefix}{self.SUFFIX}"
+
+    def put(self, prefix: str, body: bytes, etag: Optional[str]) -> None:
+        """
+        Save range body for given prefix, replacing any existing entry.
+
+        Args:
+            prefix:
+                Five-character hexadecimal prefix.
+            body:
+                Range response body from API.
+            etag:
+                Range response's ETag from API, if any.
+        """
+        path = self.path(prefix)
+        temp = path.with_suffix('.tmp')
+        temp.write_bytes(self._encode(etag, body))
+        os.replace(temp, path)
+        logger.debug("Cached range %r with ETag %s", prefix, etag)
+
+    def touch(self, prefix: str) -> None:
+        """
+        Mark entry as fresh again, eg. after API reports it not modified.
+        """
+        self.path(prefix).touch()
+
+    def _decode(self, data: bytes) -> tuple[Optional[str], bytes]:
+        header, _, body = self._decompressor.decompress(data).partition(b'\n')
+        etag = header.decode('ascii') if header else None
+        return etag, body
+
+    def _encode(self, etag: Optional[str], body: bytes) -> bytes:
+        header = b'' if etag is None else etag.encode('ascii')
+        return self._compressor.compress(header + b'\n' + body)
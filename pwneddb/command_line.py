@@ -1,10 +1,15 @@
 
 import argparse
+import asyncio
+import atexit
 import logging
+import logging.handlers
 import os
 from pathlib import Path
+import queue
 import sys
 import time
+from typing import Callable
 
 from . import utils
 from .db import connect
@@ -14,6 +19,29 @@ from .updatinator import Updatinator
 logger = logging.getLogger(__name__)
 
 
+def _integer_at_least(minimum: int) -> Callable[[str], int]:
+    """
+    Build argparse `type` function for integer options with a lower bound.
+
+    Args:
+        minimum:
+            Smallest acceptable value.
+
+    Returns:
+        Function to convert option's string to an integer, raising
+        `argparse.ArgumentTypeError` if it's not one, or is too small.
+    """
+    def convert(string: str) -> int:
+        try:
+            value = int(string)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid int value: {string!r}") from None
+        if value < minimum:
+            raise argparse.ArgumentTypeError(f"must be at least {minimum}: {value}")
+        return value
+    return convert
+
+
 class Formatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
         """
@@ -33,6 +61,8 @@ class CommandLine:
     """
     Command-line interface to whole program.
     """
+    PROGRESS_INTERVAL = 0.1             # Minimum seconds between progress updates
+
     def __init__(self, arguments: list[str]):
         parser = self.make_parser()
         self.options = parser.parse_args(arguments)
@@ -40,14 +70,23 @@ class CommandLine:
         self.terminal_width, _ = os.get_terminal_size()
         self.total_prefixes = 0
         self.total_passwords = 0
+        self._last_progress = 0.0
 
         logger.warning("Started.")
         self.session = connect(Path(self.options.db_path))
-        self.updater = Updatinator(self.session)
+        self.updater = Updatinator(
+            self.session,
+            concurrency=self.options.concurrency,
+            workers=self.options.workers,
+        )
+        self.updater.prefixes.seed()
 
     def configure_logging(self) -> None:
         """
         Log to a file in the same folder as the database file.
+
+        The file is written to by a background thread, so that callers of the
+        logger never have to wait on disk I/O.
         """
         level = logging.INFO
         if self.options.verbose:
@@ -59,9 +98,14 @@ class CommandLine:
         handler = logging.FileHandler(filename=path)
         handler.setFormatter(Formatter())
 
+        log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        listener.start()
+        atexit.register(listener.stop)
+
         logging.basicConfig(
             format="%(message)s",
-            handlers=(handler,),
+            handlers=(logging.handlers.QueueHandler(log_queue),),
             level=level,
         )
 
@@ -71,6 +115,16 @@ class CommandLine:
         parser.add_argument(
             'db_path', metavar='DB_PATH', help="path to password database",
         )
+        parser.add_argument(
+            '-c', '--concurrency', metavar='N', type=_integer_at_least(1), default=64,
+            help='maximum number of simultaneous downloads (default: %(default)s)',
+        )
+        parser.add_argument(
+            '-w', '--workers', metavar='N', type=_integer_at_least(0),
+            default=(os.cpu_count() or 1) - 1,
+            help='number of processes to parse downloads with, zero for none '
+                 '(default: %(default)s)',
+        )
 
         # Logger verbosity
         group = parser.add_mutually_exclusive_group()
@@ -84,19 +138,45 @@ class CommandLine:
         )
         return parser
 
-    def create_new(self) -> None:
-        prefix, num_passwords = self.updater.create_new()
-        logger.info(
-            f"Prefix {prefix!r} and its {num_passwords} password hashes created."
-        )
-        self.total_prefixes += 1
-        self.total_passwords += num_passwords
-        self.print_progress(prefix)
+    async def create_many(self) -> bool:
+        """
+        Download and save the next batch of missing prefixes.
+
+        Returns:
+            False if there were no missing prefixes left to download.
+        """
+        missing = self.updater.prefixes.find_missing_many(self.options.concurrency)
+        if not missing:
+            return False
+
+        created = await self.updater.create_many(missing)
+        self.count_created(created)
+        self.print_progress(created[-1][0])
+        return True
+
+    def count_created(self, created: list[tuple[str, int]]) -> None:
+        """
+        Log newly created prefixes, and add them to our running totals.
+        """
+        for prefix, num_passwords in created:
+            logger.info(
+                "Prefix %r and its %s password hashes created.", prefix, num_passwords
+            )
+            self.total_prefixes += 1
+            self.total_passwords += num_passwords
 
     def print_progress(self, prefix: str) -> None:
-        completed = self.updater.prefixes.percentage_complete()
-        progress = f"{completed:.2f}% completed. Downloaded prefix {prefix}."
-        print(progress, end="\r")
+        """
+        Overwrite progress line on terminal, at most every `PROGRESS_INTERVAL`.
+        """
+        now = time.perf_counter()
+        if (now - self._last_progress) < self.PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+
+        completed = self.updater.percentage_complete()
+        sys.stdout.write(f"{completed:.2f}% completed. Downloaded prefix {prefix}.\r")
+        sys.stdout.flush()
 
     def run(self) -> int:
         started = time.perf_counter()
@@ -105,15 +185,18 @@ class CommandLine:
         logger.info(start)
         print(start)
 
-        while True:
-            try:
-                self.create_new()
-            except SystemExit as e:
-                self.session.close()
-                logger.error(e)
-                print()
-                print(e, file=sys.stderr)
-                break
+        interrupted = None
+        try:
+            asyncio.run(self._run_async())
+        except SystemExit as e:
+            # Keep the downloads that finished before we were interrupted
+            interrupted = e
+            logger.error(e)
+            self.count_created(self.updater.save_downloaded())
+        finally:
+            print()
+            self.updater.api.close()
+            self.session.close()
 
         elapsed = time.perf_counter() - started
         duration = utils.duration(elapsed)
@@ -124,4 +207,13 @@ class CommandLine:
         print(summary)
         logger.warning(summary)
 
+        if interrupted is not None:
+            raise interrupted
         return 0
+
+    async def _run_async(self) -> None:
+        try:
+            while await self.create_many():
+                pass
+        finally:
+            await self.updater.async_api.close()
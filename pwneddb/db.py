@@ -4,14 +4,17 @@ Database interface via SQLAlchemy.
 CREATE TABLE prefixes (
     id INTEGER NOT NULL,
     prefix VARCHAR(5) NOT NULL,
-    updated FLOAT NOT NULL,
+    updated FLOAT,
+    etag VARCHAR,
     PRIMARY KEY (id),
     UNIQUE (prefix)
 );
 
+CREATE INDEX ix_prefixes_updated_prefix ON prefixes (updated, prefix);
+
 CREATE TABLE passwords (
     id INTEGER NOT NULL,
-    sha1 VARCHAR(40) NOT NULL,
+    sha1 BLOB NOT NULL,
     password VARCHAR,
     count INTEGER NOT NULL,
     prefix_id INTEGER NOT NULL,
@@ -24,12 +27,29 @@ CREATE TABLE passwords (
 from __future__ import annotations
 
 from datetime import datetime, timezone
+import functools
 import logging
 from pathlib import Path
 import time
 from typing import Any, Iterable, Optional, Type
-
-from sqlalchemy import create_engine, event, func, ForeignKey, select, String
+import weakref
+
+from sqlalchemy import (
+    bindparam,
+    create_engine,
+    event,
+    ForeignKey,
+    func,
+    Index,
+    insert,
+    inspect,
+    LargeBinary,
+    literal,
+    Select,
+    select,
+    String,
+    update,
+)
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import (
     DeclarativeBase,
@@ -44,14 +64,87 @@ from sqlalchemy.orm import (
 
 logger = logging.getLogger(__name__)
 
+# Deletes every hexadecimal digit, see `_clean_prefix()`
+_NON_HEX = str.maketrans('', '', '0123456789abcdef')
+
+# Engines whose tables have already been created by `connect()`. Keyed by
+# engine, not URL: every in-memory engine is a new, empty database, and a file
+# may have been deleted or replaced since its tables were created.
+_TABLES_CREATED: weakref.WeakSet[Engine] = weakref.WeakSet()
+
 
 class Base(DeclarativeBase):
     pass
 
 
-def connect(path: Optional[Path] = None) -> Session:
+def set_sqlite_pragma(dbapi_connection: Any, connection_record: Any) -> None:
+    """
+    Configure each new SQLite3 connection for speed.
+
+    Attached by `connect()` to just the engine it creates, so that each
+    connection only runs its PRAGMAs once.
+    """
+    logger.debug("Running SQLite3 PRAGMAs")
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys = ON;')
+    cursor.execute('PRAGMA journal_mode = WAL;')
+    cursor.execute('PRAGMA synchronous = NORMAL;')
+    cursor.execute('PRAGMA temp_store = MEMORY;')
+    cursor.execute('PRAGMA optimize;')
+    cursor.close()
+
+
+def set_sqlite_pragma_not_durable(dbapi_connection: Any, connection_record: Any) -> None:
+    """
+    Configure each new SQLite3 connection for even more speed, but no safety.
+
+    Attached by `connect()` after `set_sqlite_pragma()`, when asked for a
+    database that needn't be durable. The journal is kept in memory and
+    nothing is ever synced to disk, so a crash can corrupt the database.
+    """
+    logger.debug("Running SQLite3 PRAGMAs, without durability")
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode = MEMORY;')
+    cursor.execute('PRAGMA synchronous = OFF;')
+    cursor.execute('PRAGMA locking_mode = EXCLUSIVE;')
+    cursor.close()
+
+
+def connect(
+    path: Optional[Path] = None,
+    *,
+    durable: bool = True,
+    engine: Optional[Engine] = None,
+) -> Session:
     """
     Create an SQLAlchemy session instance.
+
+    Args:
+        path:
+            SQLite3 database file, created if missing. An in-memory database
+            is used if not given.
+        durable:
+            Set to False to trade crash-safety for faster writes, eg. for a
+            throwaway database. See `set_sqlite_pragma_not_durable()`.
+        engine:
+            Use an existing engine, eg. one shared between tests, instead of
+            creating a new one. The `path` and `durable` arguments are
+            ignored, and the engine is used exactly as configured. Its
+            tables are only created the first time it is given.
+    """
+    if engine is None:
+        engine = _create_engine(path, durable)
+    if engine not in _TABLES_CREATED:
+        Base.metadata.create_all(engine)
+        _TABLES_CREATED.add(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    return session
+
+
+def _create_engine(path: Optional[Path], durable: bool) -> Engine:
+    """
+    Create engine for given database file, with our PRAGMAs attached.
     """
     location = ":memory:"
     if path is not None:
@@ -61,23 +154,39 @@ def connect(path: Optional[Path] = None) -> Session:
         else:
             logger.warning("Creating new SQLite3 database: %s", path)
 
-    @event.listens_for(Engine, "connect")
-    def set_sqlite_pragma(dbapi_connection: Any, connection_record: Any) -> None:
-        logger.debug("Running SQLite3 PRAGMAs")
-        cursor = dbapi_connection.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        cursor.execute('PRAGMA journal_mode = WAL;')
-        cursor.execute('PRAGMA synchronous = NORMAL;')
-        cursor.execute('PRAGMA temp_store = MEMORY;')
-        cursor.execute('PRAGMA optimize;')
-        cursor.close()
-
     uri = f"sqlite+pysqlite:///{location}"
-    engine = create_engine(uri)
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    return session
+    engine = create_engine(uri, query_cache_size=1200)
+    event.listen(engine, "connect", set_sqlite_pragma)
+    if not durable:
+        event.listen(engine, "connect", set_sqlite_pragma_not_durable)
+    return engine
+
+
+def _clean_prefix(prefix: str) -> str:
+    """
+    Validate and normalise a five-character hexadecimal prefix.
+
+    Raises:
+        ValueError:
+            If prefix is the wrong length, or not hexadecimal.
+
+    Returns:
+        Lower-case copy of prefix.
+    """
+    if len(prefix) != 5:
+        raise ValueError(f"Given prefix not 5-characters long: {prefix!r}")
+    cleaned = prefix.lower()
+    if cleaned.translate(_NON_HEX):
+        raise ValueError(f"Given prefix not hexadecimal: {prefix!r}")
+    return cleaned
+
+
+@functools.cache
+def _count_rows_statement(model: Type[Base]) -> Select[tuple[int]]:
+    """
+    Build statement to count all rows of the given model's table, just once.
+    """
+    return select(func.count()).select_from(model)
 
 
 class Manager:
@@ -101,8 +210,7 @@ class Manager:
         """
         Count total number of rows in table.
         """
-        statement = select(func.count()).select_from(self.model)
-        num_rows = self.session.scalars(statement).first()
+        num_rows = self.session.scalar(_count_rows_statement(self.model))
         assert num_rows is not None
         return int(num_rows)
 
@@ -112,9 +220,9 @@ class Password(Base):
 
     # Fields
     id: Mapped[int] = mapped_column(primary_key=True)
-    sha1: Mapped[str] = mapped_column(String(40))
+    sha1: Mapped[bytes] = mapped_column(LargeBinary(20))
     password: Mapped[Optional[str]]
-    count: Mapped[int]
+    count: Mapped[int]                  # Variable-width, 1-3 bytes for most
 
     # Relationships
     prefix_id: Mapped[int] = mapped_column(ForeignKey("prefixes.id"))
@@ -122,7 +230,14 @@ class Password(Base):
 
     def __repr__(self) -> str:
         password = "" if self.password is None else f" ({self.password!r})"
-        return f"<{self.__class__.__name__}: {self.sha1}{password} {self.count:,}>"
+        return f"<{self.__class__.__name__}: {self.sha1_hex}{password} {self.count:,}>"
+
+    @property
+    def sha1_hex(self) -> str:
+        """
+        SHA-1 hash as a lower-case, 40-character hexadecimal string.
+        """
+        return self.sha1.hex()
 
     @staticmethod
     def objects(session: Session) -> PasswordManager:
@@ -131,10 +246,35 @@ class Password(Base):
 
 class PasswordManager(Manager):
     """
-    Functions involving multiple Prefix models.
+    Functions involving multiple Password models.
     """
     model = Password
 
+    def insert_hashes(self, prefix_id: int, hashes: Iterable[tuple[bytes, int]]) -> int:
+        """
+        Insert many new passwords for the given prefix.
+
+        Uses a single Core INSERT, bypassing the overhead of creating ORM
+        instances - and does not commit. The INSERT is against the table, not
+        the model, which also skips the ORM's bulk insert handling.
+
+        Args:
+            prefix_id:
+                Primary key of already flushed `Prefix` record.
+            hashes:
+                Raw 20-byte password hashes and their counts.
+
+        Returns:
+            Number of password records inserted.
+        """
+        rows = [
+            {'sha1': sha1, 'count': count, 'prefix_id': prefix_id}
+            for sha1, count in hashes
+        ]
+        if rows:
+            self.session.execute(_INSERT_PASSWORDS, rows)
+        return len(rows)
+
 
 class Prefix(Base):
     """
@@ -147,11 +287,16 @@ class Prefix(Base):
 
     """
     __tablename__ = 'prefixes'
+    __table_args__ = (
+        # Find missing (NULL) prefixes in order, and the oldest updated ones
+        Index('ix_prefixes_updated_prefix', 'updated', 'prefix'),
+    )
 
     # Fields
     id: Mapped[int] = mapped_column(primary_key=True)
     prefix: Mapped[str] = mapped_column(String(5), unique=True)
-    updated: Mapped[float] = mapped_column(default=time.time)
+    updated: Mapped[Optional[float]] = mapped_column(default=time.time)
+    etag: Mapped[Optional[str]]
 
     # Relationships
     passwords: Mapped[list["Password"]] = relationship(
@@ -172,10 +317,7 @@ class Prefix(Base):
 
     @validates('prefix')
     def validate_prefix(self, key: str, prefix: str) -> str:
-        if len(prefix) != 5:
-            raise ValueError(f"Given prefix not 5-characters long: {prefix!r}")
-        prefix = prefix.casefold()
-        return prefix
+        return _clean_prefix(prefix)
 
     def get_updated(self) -> datetime | None:
         """
@@ -187,72 +329,215 @@ class Prefix(Base):
         return updated
 
 
+# Statements used for every batch of downloads. Building them just once saves
+# their construction, and lets SQLAlchemy reuse their memoised cache keys.
+_COUNT_COMPLETE = (
+    select(func.count())
+    .select_from(Prefix)
+    .where(Prefix.updated.is_not(None))
+)
+_FIND_MISSING = (
+    select(Prefix.prefix)
+    .where(Prefix.updated.is_(None))
+    .order_by(Prefix.prefix)
+    .limit(bindparam('limit'))
+)
+_INSERT_PASSWORDS = insert(Base.metadata.tables['passwords'])
+_INSERT_PREFIXES = insert(Base.metadata.tables['prefixes'])
+_INSERT_UPDATED = insert(Prefix).returning(Prefix.id)
+_LARGEST_PREFIX = select(func.max(Prefix.prefix)).where(Prefix.updated.is_not(None))
+_OLDEST = (
+    select(Prefix)
+    .where(Prefix.updated.is_not(None))
+    .order_by(Prefix.updated)
+    .limit(1)
+)
+_UPDATE_UPDATED = (
+    update(Prefix)
+    .where(Prefix.prefix == bindparam('key'))
+    .values(updated=bindparam('updated'), etag=bindparam('etag'))
+    .returning(Prefix.id)
+)
+
+
 class PrefixManager(Manager):
     """
     Functions involving multiple Prefix models.
+
+    Every possible prefix gets its own record up-front, see `seed()`. Those
+    that we haven't yet downloaded have an `updated` value of NULL.
     """
     model = Prefix
     TOTAL_ROWS = 16**5                  # Five hexadecimal characters
+    PERCENT_PER_ROW = 100.0 / TOTAL_ROWS
 
-    def find_missing(self) -> Optional[str]:
+    def add_all(self, instances: Iterable[Base]) -> None:
         """
-        Return a prefix for a record we don't yet have.
+        Add many new prefix records with a single INSERT, then commit.
+
+        Like `PasswordManager.insert_hashes()`, uses a Core INSERT against
+        the table, skipping the ORM's per-instance flush. The instances are
+        only read from: they stay transient, so are not added to the session,
+        nor given their IDs.
+
+        Instances that have passwords, or that already belong to a session,
+        need the ORM's unit of work, so if there are any all of the instances
+        are added via `Manager.add_all()` instead.
 
-        Currently finds the largest prefix and increases it numerically by one.
-        Obviously, this will only work if we are very careful to only add
-        records one at a time and in order.
+        Args:
+            instances:
+                New `Prefix` instances, already validated on creation.
 
-        More robust would be to create all million or so possible prefix records
-        with an `updated` value of NULL when setting up a new database, then
-        simply select for NULL against our prefixes table.
+        Raises:
+            TypeError:
+                If any instance isn't a `Prefix`. Nothing is added.
+        """
+        prefixes: list[Prefix] = []
+        for instance in instances:
+            if not isinstance(instance, Prefix):
+                raise TypeError(f"Expected Prefix instance, not: {instance!r}")
+            prefixes.append(instance)
+        if any(not inspect(prefix).transient or prefix.passwords for prefix in prefixes):
+            super().add_all(prefixes)
+            return
+
+        rows = []
+        for prefix in prefixes:
+            # Same as an ORM flush, a NULL update time gets the default
+            updated = time.time() if prefix.updated is None else prefix.updated
+            rows.append({'prefix': prefix.prefix, 'updated': updated, 'etag': prefix.etag})
+        if rows:
+            self.session.execute(_INSERT_PREFIXES, rows)
+        self.session.commit()
+
+    def count_complete(self) -> int:
+        """
+        Count the number of prefixes that have been downloaded.
+        """
+        num_rows = self.session.scalar(_COUNT_COMPLETE)
+        assert num_rows is not None
+        return int(num_rows)
 
-        Given that we've already decided to be polite, and not to hammer the API
-        with a hundred multithreaded requests at a time, this implementation
-        will suffice.
+    def find_missing(self) -> Optional[str]:
+        """
+        Return a prefix for a record we don't yet have.
 
         Returns:
             Prefix for a missing record, or None if no missing prefixes found.
         """
-        largest = self.largest_prefix()
+        missing = self.find_missing_many(1)
+        return missing[0] if missing else None
 
-        # Empty table?
-        if largest is None:
-            return '00000'
-        value = int(largest, 16) + 1
+    def find_missing_many(self, limit: int) -> list[str]:
+        """
+        Return prefixes for up to `limit` records we don't yet have.
 
-        # Full table?
-        if value == self.TOTAL_ROWS:
-            return None
+        Allows several prefixes to be downloaded concurrently. The lookup is
+        served by the index on `updated`, so is cheap even for a full table.
 
-        prefix = f"{value:0>5x}"
-        return prefix
+        Args:
+            limit:
+                Maximum number of prefixes to return.
+
+        Returns:
+            List of missing prefixes, in order. Empty if none found.
+        """
+        prefixes = list(self.session.scalars(_FIND_MISSING, {'limit': limit}))
+        return prefixes
 
     def largest_prefix(self) -> Optional[str]:
         """
-        Find the largest prefix value in the database.
+        Find the largest prefix value that has been downloaded.
 
         Returns:
             Largest prefix, or None if there are no prefixes to be had.
         """
-        statement = select(self.model.prefix).order_by(self.model.prefix.desc())
-        result = self.session.execute(statement).first()
-        if result is None:
-            return None
-        prefix = result[0]
-        assert isinstance(prefix, str)
+        prefix = self.session.scalar(_LARGEST_PREFIX)
+        assert prefix is None or isinstance(prefix, str)
+        return prefix
+
+    def mark_updated(self, prefix: str, etag: Optional[str]) -> int:
+        """
+        Record that the given prefix has just been downloaded.
+
+        The prefix record is created if it doesn't yet exist. Does not commit.
+
+        This is an UPDATE, then an INSERT only if that found nothing, rather
+        than a single upsert: SQLAlchemy's SQLite `insert()` construct can't
+        be cached, so would be compiled afresh for every prefix.
+
+        Args:
+            prefix:
+                Five-character hexadecimal prefix.
+            etag:
+                ETag of range as downloaded.
+
+        Returns:
+            Primary key of prefix record.
+        """
+        prefix = prefix.casefold()
+        values = {'updated': time.time(), 'etag': etag}
+        prefix_id = self.session.scalar(_UPDATE_UPDATED, {'key': prefix, **values})
+        if prefix_id is None:
+            prefix_id = self.session.scalar(_INSERT_UPDATED, {'prefix': prefix, **values})
+        assert isinstance(prefix_id, int)
+        return prefix_id
+
+    def oldest(self) -> Optional[Prefix]:
+        """
+        Find the downloaded prefix that was updated the longest time ago.
+
+        Returns:
+            Least-recently updated prefix, or None if there are no prefixes.
+        """
+        prefix = self.session.scalars(_OLDEST).first()
+        assert prefix is None or isinstance(prefix, Prefix)
         return prefix
 
-    def percentage_complete(self) -> float:
+    def percentage_complete(self, num_complete: Optional[int] = None) -> float:
         """
         Fetch percentage of possible prefixes that we have.
 
-        We take advantage of the fact that we download our prefixes in strict
-        numerical order to avoid the expensive full-table scan that SQLite
-        always uses for a COUNT(*) query.
+        Args:
+            num_complete:
+                Number of downloaded prefixes, if already known. Saves a query
+                when given, otherwise it is counted.
         """
-        largest = self.largest_prefix()
-        rows = 0
-        if largest is not None:
-            rows = int(largest, 16) + 1
-        percentage = (rows / self.TOTAL_ROWS) * 100.0
+        if num_complete is None:
+            num_complete = self.count_complete()
+        percentage = num_complete * self.PERCENT_PER_ROW
         return percentage
+
+    def seed(self) -> int:
+        """
+        Create a record, not yet downloaded, for every possible prefix.
+
+        Prefixes that already have a record are left alone, so this is safe
+        to run against a partially downloaded database. All the prefixes are
+        generated inside SQLite by a single INSERT, from a recursive CTE.
+
+        Returns:
+            Number of prefix records created.
+        """
+        num_rows = self.count_rows()
+        if num_rows >= self.TOTAL_ROWS:
+            return 0
+
+        numbers = select(literal(0).label('value')).cte('numbers', recursive=True)
+        numbers = numbers.union_all(
+            select(numbers.c.value + 1).where(numbers.c.value < self.TOTAL_ROWS - 1)
+        )
+        statement = (
+            insert(self.model)
+            .from_select(
+                ['prefix'],
+                select(func.printf('%05x', numbers.c.value)),
+                include_defaults=False,
+            )
+            .prefix_with('OR IGNORE')
+        )
+        self.session.execute(statement)
+        self.session.commit()
+        num_created = self.count_rows() - num_rows
+        logger.info("Created %s new prefix records", f"{num_created:,}")
+        return num_created
@@ -2,13 +2,15 @@
 Update the database using the API.
 """
 
+import asyncio
 import logging
 import time
+from typing import Optional
 
 from sqlalchemy.orm import Session
 
-from .api import PwnedPasswordsAPIv3
-from .db import Password, Prefix, PrefixManager
+from .api import AsyncPwnedPasswordsAPIv3, HashCounts, PwnedPasswordsAPIv3, Range
+from .db import Password, PasswordManager, Prefix, PrefixManager
 
 
 logger = logging.getLogger(__name__)
@@ -25,9 +27,37 @@ class Updatinator:
     2. Update phase where we find an old prefix and update it.
 
     """
-    def __init__(self, database_session: Session):
+    def __init__(
+        self,
+        database_session: Session,
+        *,
+        concurrency: int = 64,
+        workers: int = 0,
+    ):
+        """
+        Initialiser.
+
+        Args:
+            database_session:
+                SQLAlchemy session to save records with.
+            concurrency:
+                Maximum number of simultaneous API requests by `create_many()`.
+            workers:
+                Number of processes used by `create_many()` to parse responses.
+                All database writes stay with this process and its session.
+        """
+        self.passwords = PasswordManager(database_session)
         self.prefixes = PrefixManager(database_session)
         self.api = PwnedPasswordsAPIv3()
+        self.async_api = AsyncPwnedPasswordsAPIv3(
+            max_requests=concurrency, workers=workers,
+        )
+
+        # Number of downloaded prefixes, counted once then kept up-to-date.
+        self._num_complete: Optional[int] = None
+
+        # Finished downloads from `create_many()`, not yet saved.
+        self._downloaded: list[tuple[str, Range]] = []
 
     def create_new(self) -> tuple[str, int]:
         """
@@ -39,31 +69,181 @@ class Updatinator:
         missing = self.prefixes.find_missing()
         if missing is None:
             message = "No missing prefixes found"
-            logging.error(message)
+            logger.error(message)
             raise RuntimeError(message)
 
-        logging.debug("Download missing prefix %r", missing)
-        hashes = self.api.fetch_range(missing)
-        passwords = []
-        for sha1, count in hashes:
-            passwords.append(Password(sha1=sha1, count=count))
+        logger.debug("Download missing prefix %r", missing)
+        range_ = self.api.fetch_range(missing)
+        created = self._save_all([(missing, range_)])
+        return created[0]
+
+    def create_new_batch(self, limit: int) -> list[tuple[str, int]]:
+        """
+        Add up to `limit` new prefixes and their passwords, with a single commit.
+
+        Prefixes are downloaded one after another, then saved together. If
+        we're asked to exit part-way through, the prefixes downloaded so far
+        are saved before the `SystemExit` is allowed to continue.
+
+        Args:
+            limit:
+                Maximum number of prefixes to download and save.
+
+        Returns:
+            List of 2-tuples, each containing prefix then how many password
+            hashes it had.
+        """
+        downloaded = []
+        try:
+            for missing in self.prefixes.find_missing_many(limit):
+                logger.debug("Download missing prefix %r", missing)
+                downloaded.append((missing, self.api.fetch_range(missing)))
+        except SystemExit:
+            self._save_all(downloaded)
+            raise
+        return self._save_all(downloaded)
+
+    def percentage_complete(self) -> float:
+        """
+        Fetch percentage of possible prefixes that we have.
+
+        The database is only queried the first time, after which we keep
+        count ourselves. See `PrefixManager.percentage_complete()`.
+        """
+        if self._num_complete is None:
+            self._num_complete = self.prefixes.count_complete()
+        return self.prefixes.percentage_complete(self._num_complete)
+
+    async def create_many(self, prefixes: list[str]) -> list[tuple[str, int]]:
+        """
+        Download the given prefixes concurrently, then add them and their passwords.
+
+        Each download is kept as soon as it finishes, and they're all saved
+        together once the last one has. If we're asked to exit part-way
+        through, call `save_downloaded()` to keep those already finished.
+
+        Args:
+            prefixes:
+                Missing prefixes, eg. from `PrefixManager.find_missing_many()`.
+
+        Returns:
+            List of 2-tuples, each containing prefix then how many password
+            hashes it had, in the order their downloads finished.
+        """
+        logger.debug("Download %s missing prefixes from %r", len(prefixes), prefixes[0])
+
+        async def fetch(prefix: str) -> None:
+            range_ = await self.async_api.fetch_range(prefix)
+            self._downloaded.append((prefix, range_))
+
+        await asyncio.gather(*(fetch(prefix) for prefix in prefixes))
+        return self.save_downloaded()
+
+    def save_downloaded(self) -> list[tuple[str, int]]:
+        """
+        Save the downloads that `create_many()` has finished, with one commit.
+
+        Returns:
+            List of 2-tuples, each containing prefix then how many password
+            hashes it had.
+        """
+        downloaded, self._downloaded = self._downloaded, []
+        return self._save_all(downloaded)
+
+    def _save_all(self, downloaded: list[tuple[str, Range]]) -> list[tuple[str, int]]:
+        """
+        Add new prefixes and their passwords to database, then commit once.
+
+        Args:
+            downloaded:
+                List of 2-tuples, each containing prefix then its range data.
+
+        Returns:
+            List of 2-tuples, each containing prefix then how many password
+            hashes it had.
+        """
+        created = []
+        for missing, range_ in downloaded:
+            created.append(self._save(missing, range_))
+
+        start = time.perf_counter()
+        self.prefixes.session.commit()
+        if self._num_complete is not None:
+            self._num_complete += len(created)
+        logger.debug(
+            "Committed %s new prefixes to database in %.3fs",
+            len(created), time.perf_counter() - start,
+        )
+        return created
+
+    def _save(self, missing: str, range_: Range) -> tuple[str, int]:
+        """
+        Add new prefix and its passwords to database, without committing.
+
+        Args:
+            missing:
+                Prefix to create.
+            range_:
+                Its password hashes and their counts, and its ETag, from the API.
+
+        Returns:
+            Prefix of newly created prefix and how many password hashes it had.
+        """
+        hashes, etag = range_
+        assert hashes is not None, "unconditional fetch cannot be 'not modified'"
         start = time.perf_counter()
-        self.prefixes.add(Prefix(prefix=missing, passwords=passwords))
+        prefix_id = self.prefixes.mark_updated(missing, etag)
+        num_passwords = self.passwords.insert_hashes(prefix_id, hashes)
         logger.debug(
-            f"Added {len(passwords):,} new passwords to database in "
-            f"{time.perf_counter() - start:.3f}s"
+            "Added %s new passwords to database in %.3fs",
+            num_passwords, time.perf_counter() - start,
         )
-        return missing, len(passwords)
+        return missing, num_passwords
 
-    def update_existing(self) -> None:
+    def update_existing(self) -> tuple[str, Optional[int]]:
         """
-        Update an already exsiting prefix and its passwords.
+        Update the least-recently updated prefix and its passwords.
 
-        * Will finding the oldest be too slow? Probably not, only four million
-          prefixes.
-        * Get feedback about how many hashes were actually updated. Should we
-          abort update if no new data seems to be available?
-        * Be careful not to lose existing plain-text passwords!
-        * Update timestamp even if no hashes are updated.
+        The download is made conditional on the ETag we saved last time, so
+        unchanged prefixes cost us almost nothing: we skip parsing and leave
+        the passwords table alone, but still bump the prefix's timestamp.
+
+        Existing rows are updated in-place, so any plain-text passwords we've
+        already merged are kept.
+
+        * Hashes no longer returned by the API are kept for now. Delete them?
         * Show average age of our records? Mean or median?
+
+        Returns:
+            Prefix updated and how many password hashes it now has, or None
+            for the count if the prefix was unchanged.
         """
+        prefix = self.prefixes.oldest()
+        if prefix is None:
+            message = "No existing prefixes found"
+            logger.error(message)
+            raise RuntimeError(message)
+
+        logger.debug("Update existing prefix %r", prefix.prefix)
+        hashes, etag = self.api.fetch_range(prefix.prefix, etag=prefix.etag)
+        prefix.updated = time.time()
+        prefix.etag = etag
+        if hashes is None:
+            self.prefixes.session.commit()
+            return prefix.prefix, None
+
+        self._update_passwords(prefix, hashes)
+        self.prefixes.session.commit()
+        return prefix.prefix, len(prefix.passwords)
+
+    def _update_passwords(self, prefix: Prefix, hashes: HashCounts) -> None:
+        """
+        Update counts of existing passwords, and add any new ones.
+        """
+        existing = {password.sha1: password for password in prefix.passwords}
+        for sha1, count in hashes:
+            password = existing.get(sha1)
+            if password is None:
+                prefix.passwords.append(Password(sha1=sha1, count=count))
+            else:
+                password.count = count
@@ -1,7 +1,26 @@
 
+import bisect
 from typing import Union
 
 
+# Mean Gregorian year
+_YEAR = int(60 * 60 * 24 * 365.2425)
+
+# Units of time, smallest first
+_UNITS = (
+    ('second', 1),
+    ('minute', 60),
+    ('hour', 60 * 60),
+    ('day', 60 * 60 * 24),
+    ('week', 60 * 60 * 24 * 7),
+    ('month', _YEAR // 12),
+    ('year', _YEAR),
+)
+
+# Least number of seconds for which each unit is used, ie. two of them
+_THRESHOLDS = tuple(2 * length for _, length in _UNITS)
+
+
 def duration(seconds: Union[float, int]) -> str:
     """
     Return 'human' description of number of seconds given. eg.
@@ -17,18 +36,6 @@ def duration(seconds: Union[float, int]) -> str:
     Returns (str):
         Approximate (in both senses) human expression of time.
     """
-    # Mean Gregorian year
-    YEAR = int(60 * 60 * 24 * 365.2425)
-    DURATIONS = {
-        'year': YEAR,
-        'month': YEAR // 12,
-        'week': 60 * 60 * 24 * 7,
-        'day': 60 * 60 * 24,
-        'hour': 60 * 60,
-        'minute': 60,
-        'second': 1,
-    }
-
     # Validate input
     try:
         seconds = int(seconds)
@@ -39,15 +46,9 @@ def duration(seconds: Union[float, int]) -> str:
         raise ValueError('Positive number expected, given: {!r}'.format(seconds))
 
     # Use two or more units of whatever time unit we have
-    duration = f"{seconds:,} seconds"
-    for key in DURATIONS:
-        length = DURATIONS[key]
-        count = seconds // length
-        if count > 1:
-            return f"{count:,} {key}s"
-
-    # Special case
-    if seconds == 1:
-        return '1 second'
-
-    return duration
+    index = bisect.bisect_right(_THRESHOLDS, seconds) - 1
+    if index < 0:
+        return '1 second' if seconds == 1 else f"{seconds} seconds"
+
+    key, length = _UNITS[index]
+    return f"{seconds // length:,} {key}s"
@@ -1,22 +1,58 @@
 
 from contextlib import contextmanager
 import logging
+import os
+import time
 from typing import Any, Iterator, Optional, TypeAlias, Union
-from unittest import TestCase
+from unittest import IsolatedAsyncioTestCase, mock, TestCase
 
 from sqlalchemy import create_engine, event
-from sqlalchemy.engine import Connection, NestedTransaction, Engine
+from sqlalchemy.engine import Connection, Engine, NestedTransaction, RootTransaction
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
 
-from pwneddb.db import Base
+from pwneddb.cache import RangeCache
+from pwneddb.db import Base, PrefixManager
 
 
 JSON: TypeAlias = Union[dict[str, Any], list[Any]]
 
 
+# One in-memory database, shared by every test that needs one. `StaticPool`
+# always hands out the same connection, without which it would be lost.
+ENGINE = create_engine(
+    'sqlite+pysqlite:///:memory:',
+    connect_args={'check_same_thread': False},
+    poolclass=StaticPool,
+)
+
+
+@event.listens_for(ENGINE, "connect")
+def do_connect(dbapi_connection: Any, connection_record: Any) -> None:
+    # Enable nested transactions for SQLite, see:
+    # https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#pysqlite-serializable
+    dbapi_connection.isolation_level = None
+
+    # Test data is thrown away, so never needs to be durable
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode = MEMORY;')
+    cursor.execute('PRAGMA synchronous = OFF;')
+    cursor.execute('PRAGMA temp_store = MEMORY;')
+    cursor.execute('PRAGMA locking_mode = EXCLUSIVE;')
+    cursor.close()
+
+
+@event.listens_for(ENGINE, "begin")
+def do_begin(conn: Connection) -> None:
+    conn.exec_driver_sql("BEGIN")
+
+
+Base.metadata.create_all(ENGINE)
+
+
 class FakeResponse:
     """
-    Fakes the interface of `requests.Response`.
+    Fakes the interface of `httpx.Response`.
 
     Use as the return value for mocked calls, eg.
 
@@ -32,7 +68,9 @@ class FakeResponse:
         self,
         *,
         content: Optional[bytes] = None,
+        headers: Optional[dict[str, str]] = None,
         json: Optional[JSON] = None,
+        status_code: int = 200,
         text: Optional[str] = None,
     ):
         """
@@ -41,19 +79,29 @@ class FakeResponse:
         Args:
             content:
                 Byte string to use as `response.content` property.
+            headers:
+                Dictionary to use as `response.headers` property.
             json:
                 Dictionary or list to return from `response.json()` method.
+            status_code:
+                Integer HTTP status code to use as `response.status_code`.
             text:
                 String to use as `response.text` property.
         """
         self._content = b'' if content is None else content
+        self._headers = {} if headers is None else headers
         self._json = {} if json is None else json
         self._text = '' if text is None else text
+        self.status_code = status_code
 
     @property
     def content(self) -> bytes:
         return self._content
 
+    @property
+    def headers(self) -> dict[str, str]:
+        return self._headers
+
     @property
     def text(self) -> str:
         return self._text
@@ -80,6 +128,22 @@ def logger_hush(level: int = logging.ERROR) -> Iterator[None]:
         logging.disable(logging.NOTSET)
 
 
+def make_stale(cache: RangeCache, prefix: str) -> None:
+    """
+    Backdate the cache's entry for prefix, until it's just past its max age.
+    """
+    old = time.time() - cache.max_age - 1
+    os.utime(cache.path(prefix), (old, old))
+
+
+def seed(session: Session, total_rows: int = 16) -> None:
+    """
+    Seed only the first few prefixes, rather than all million or so.
+    """
+    with mock.patch.object(PrefixManager, 'TOTAL_ROWS', total_rows):
+        PrefixManager(session).seed()
+
+
 class TransactionTestCase(TestCase):
     """
     Efficient test isolation for unit tests using SQLAlchemy's ORM interface.
@@ -88,37 +152,42 @@ class TransactionTestCase(TestCase):
     in any one function do not affect any other function.
 
     For efficiency's sake, the database connection and its tables are
-    created only one per test class.
+    created only once, and shared by every test case. See `ENGINE`. Each test
+    class holds one connection, inside a single outer transaction, and each
+    test runs inside a savepoint within that. The test's session creates
+    its own savepoints inside that one, so even its commits are rolled back.
     """
-    engine: Engine
+    engine: Engine = ENGINE
+    connection: Connection
+    outer_transaction: RootTransaction
     session: Session
     transaction: NestedTransaction
 
     @classmethod
     def setUpClass(cls) -> None:
-        cls.engine = create_engine('sqlite+pysqlite:///:memory:')
-        Base.metadata.create_all(cls.engine)
-
-        # Enable nested transactions for SQLite, see:
-        # https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#pysqlite-serializable
-        @event.listens_for(cls.engine, "connect")
-        def do_connect(dbapi_connection: Any, connection_record: Any) -> None:
-            dbapi_connection.isolation_level = None             # pragma: nocover
-
-        @event.listens_for(cls.engine, "begin")
-        def do_begin(conn: Connection) -> None:
-            conn.exec_driver_sql("BEGIN")
+        super().setUpClass()
+        cls.connection = cls.engine.connect()
+        cls.outer_transaction = cls.connection.begin()
 
     def setUp(self) -> None:
-        self.connection = self.engine.connect()
         self.transaction = self.connection.begin_nested()
-        self.session = Session(bind=self.connection)
+        self.session = Session(bind=self.connection, join_transaction_mode='create_savepoint')
 
     def tearDown(self) -> None:
         self.session.close()
         self.transaction.rollback()
-        self.connection.close()
 
     @classmethod
     def tearDownClass(cls) -> None:
-        Base.metadata.drop_all(cls.engine)
+        cls.outer_transaction.rollback()
+        cls.connection.close()
+        super().tearDownClass()
+
+
+class AsyncTransactionTestCase(TransactionTestCase, IsolatedAsyncioTestCase):
+    """
+    As per `TransactionTestCase`, but for tests that are coroutines.
+
+    The database session is shared with the test's event loop, which runs in
+    the same thread.
+    """
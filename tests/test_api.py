@@ -1,9 +1,19 @@
 
-from unittest import mock, TestCase
+import asyncio
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+from unittest import IsolatedAsyncioTestCase, mock, TestCase
 
-from pwneddb.api import Prefix, PwnedPasswordsAPIv3
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import httpx
 
-from .base import FakeResponse
+from pwneddb.api import AsyncPwnedPasswordsAPIv3, parse_range, Prefix, PwnedPasswordsAPIv3
+from pwneddb.cache import RangeCache
+
+from .base import FakeResponse, make_stale
 
 
 class PrefixTest(TestCase):
@@ -56,6 +66,17 @@ class PrefixTest(TestCase):
         self.assertEqual(repr(prefix), '<Prefix: 1e240>')
         self.assertEqual(int(prefix), 123_456)
 
+    def test_slots(self) -> None:
+        prefix = Prefix('decaf')
+        self.assertFalse(hasattr(prefix, '__dict__'))
+        with self.assertRaises(AttributeError):
+            prefix.other = 'value'          # type: ignore[attr-defined]
+
+    def test_unsafe_new(self) -> None:
+        prefix = Prefix._unsafe_new('decaf')
+        self.assertEqual(prefix, Prefix('decaf'))
+        self.assertEqual(int(prefix), 912_559)
+
     def test_random(self) -> None:
         for _ in range(1_000):
             prefix = Prefix.random()
@@ -75,38 +96,57 @@ class PwnedPasswordsAPIv3Test(TestCase):
     downloader: PwnedPasswordsAPIv3
 
     BODY = (
-        '003CD215739D7C1B2218670D26F81408237:1\r\n'
-        '003D68EB55068C33ACE09247EE4C639306B:4\r\n'
-        '012C192B2F16F82EA0EB9EF18D9D539B0DD:3\r\n'
-        '01330C689E5D64F660D6947A93AD634EF8F:0\r\n'
+        b'003CD215739D7C1B2218670D26F81408237:1\r\n'
+        b'003D68EB55068C33ACE09247EE4C639306B:4\r\n'
+        b'012C192B2F16F82EA0EB9EF18D9D539B0DD:3\r\n'
+        b'01330C689E5D64F660D6947A93AD634EF8F:0\r\n'
     )
     BODY_BAD = (
-        'The hash prefix was not in a valid format\r\n'
+        b'The hash prefix was not in a valid format\r\n'
     )
     BODY_BAD2 = (
-        '003CD215739D7C1B2218670D26F81408237:1\r\n'
-        '003D68EB55068C33ACE09247EE4C639306B:4\r\n'
-        '012C192B2F16F82EA0EB9EF18D9D539B0DD:null\r\n'
-        '01330C689E5D64F660D6947A93AD634EF8F:0\r\n'
+        b'003CD215739D7C1B2218670D26F81408237:1\r\n'
+        b'003D68EB55068C33ACE09247EE4C639306B:4\r\n'
+        b'012C192B2F16F82EA0EB9EF18D9D539B0DD:null\r\n'
+        b'01330C689E5D64F660D6947A93AD634EF8F:0\r\n'
     )
+    ETAG = '"0x8DC3F1B9E3A2C41"'
     PREFIX = Prefix('5baa6')
     EXPECTED = [
-        ('5baa6003cd215739d7c1b2218670d26f81408237', 1),
-        ('5baa6003d68eb55068c33ace09247ee4c639306b', 4),
-        ('5baa6012c192b2f16f82ea0eb9ef18d9d539b0dd', 3),
-        ('5baa601330c689e5d64f660d6947a93ad634ef8f', 0),
+        (bytes.fromhex('5baa6003cd215739d7c1b2218670d26f81408237'), 1),
+        (bytes.fromhex('5baa6003d68eb55068c33ace09247ee4c639306b'), 4),
+        (bytes.fromhex('5baa6012c192b2f16f82ea0eb9ef18d9d539b0dd'), 3),
+        (bytes.fromhex('5baa601330c689e5d64f660d6947a93ad634ef8f'), 0),
     ]
 
     @classmethod
     def setUpClass(cls) -> None:
         cls.downloader = PwnedPasswordsAPIv3()
+        cls.addClassCleanup(cls.downloader.close)
+
+    def test_close(self) -> None:
+        """
+        HTTP client is only created by the first request, and closed after.
+        """
+        downloader = PwnedPasswordsAPIv3()
+        self.assertIsNone(downloader.session)
+        downloader.close()
+
+        response = FakeResponse(content=self.BODY)
+        with mock.patch.object(httpx.Client, 'request', return_value=response):
+            downloader.fetch_range(self.PREFIX)
+        session = downloader.session
+        assert session is not None
+        downloader.close()
+        self.assertTrue(session.is_closed)
+        self.assertIsNone(downloader.session)
 
     def test_extract_expected_types(self) -> None:
         hashes = self.downloader._extract(self.PREFIX, self.BODY)
 
         for hash_, count in hashes:
-            self.assertIsInstance(hash_, str)
-            self.assertEqual(len(hash_), 40)
+            self.assertIsInstance(hash_, bytes)
+            self.assertEqual(len(hash_), 20)
             self.assertIsInstance(count, int)
 
         self.assertEqual(hashes, self.EXPECTED)
@@ -121,26 +161,317 @@ class PwnedPasswordsAPIv3Test(TestCase):
         with self.assertRaisesRegex(RuntimeError, message):
             self.downloader._extract(self.PREFIX, self.BODY_BAD2)
 
+    def test_extract_not_hexadecimal(self) -> None:
+        body = b'003CD215739D7C1B2218670D26F8140823Z:1\r\n'
+        message = r"^line 1: Non-hexadecimal digit found$"
+        with self.assertRaisesRegex(RuntimeError, message):
+            self.downloader._extract(self.PREFIX, body)
+
+    def test_parse_range(self) -> None:
+        self.assertEqual(parse_range(self.BODY, '5baa6'), self.EXPECTED)
+        self.assertEqual(parse_range(b'', '5baa6'), [])
+
     def test_fetch_range(self) -> None:
         """
         Run API call using mocked GET response.
         """
         prefix = self.PREFIX
-        response = FakeResponse(text=self.BODY)
+        response = FakeResponse(headers={'ETag': self.ETAG}, content=self.BODY)
         with mock.patch.object(
-            self.downloader.session, 'request', return_value=response,
-        ):
-            counts = self.downloader.fetch_range(prefix)
+            httpx.Client, 'request', return_value=response,
+        ) as mocked:
+            counts, etag = self.downloader.fetch_range(prefix)
         self.assertEqual(counts, self.EXPECTED)
+        self.assertEqual(etag, self.ETAG)
+        self.assertEqual(mocked.call_args.kwargs['headers'], {})
 
     def test_fetch_range_from_string(self) -> None:
         """
         Use plain-text (and upper-case) prefix in call to fetch_range().
         """
         prefix = '5BAA6'
-        response = FakeResponse(text=self.BODY)
+        response = FakeResponse(content=self.BODY)
+        with mock.patch.object(
+            httpx.Client, 'request', return_value=response,
+        ):
+            counts, etag = self.downloader.fetch_range(prefix)
+        self.assertEqual(counts, self.EXPECTED)
+        self.assertIsNone(etag)
+
+    def test_fetch_range_modified(self) -> None:
+        """
+        Send ETag from previous fetch, get full response with new ETag.
+        """
+        response = FakeResponse(headers={'ETag': '"0x8DC40B4A5D3E1F2"'}, content=self.BODY)
+        with mock.patch.object(
+            httpx.Client, 'request', return_value=response,
+        ) as mocked:
+            counts, etag = self.downloader.fetch_range(self.PREFIX, etag=self.ETAG)
+        self.assertEqual(mocked.call_args.kwargs['headers'], {'If-None-Match': self.ETAG})
+        self.assertEqual(counts, self.EXPECTED)
+        self.assertEqual(etag, '"0x8DC40B4A5D3E1F2"')
+
+    def test_fetch_range_not_modified(self) -> None:
+        """
+        Response body is not parsed if range unchanged since ETag given.
+        """
+        response = FakeResponse(headers={'ETag': self.ETAG}, status_code=304)
+        with mock.patch.object(
+            httpx.Client, 'request', return_value=response,
+        ), mock.patch.object(self.downloader, '_extract') as extract:
+            counts, etag = self.downloader.fetch_range(self.PREFIX, etag=self.ETAG)
+        extract.assert_not_called()
+        self.assertIsNone(counts)
+        self.assertEqual(etag, self.ETAG)
+
+
+class PwnedPasswordsAPIv3CachedTest(TestCase):
+    BODY = PwnedPasswordsAPIv3Test.BODY
+    ETAG = PwnedPasswordsAPIv3Test.ETAG
+    EXPECTED = tuple(PwnedPasswordsAPIv3Test.EXPECTED)
+
+    def setUp(self) -> None:
+        temp_folder = TemporaryDirectory()
+        self.addCleanup(temp_folder.cleanup)
+        self.cache = RangeCache(Path(temp_folder.name))
+        self.downloader = PwnedPasswordsAPIv3(cache=self.cache)
+
+    def test_memory_only(self) -> None:
+        downloader = PwnedPasswordsAPIv3()
+        response = FakeResponse(headers={'ETag': self.ETAG}, content=self.BODY)
+        with mock.patch.object(
+            httpx.Client, 'request', return_value=response,
+        ) as mocked:
+            first = downloader.fetch_range_cached('5baa6')
+            second = downloader.fetch_range_cached('5baa6')
+        mocked.assert_called_once()
+        self.assertEqual(first, self.EXPECTED)
+        self.assertIs(first, second)
+
+    def test_memory_evicted(self) -> None:
+        """
+        Only the most recently used ranges are kept in memory.
+        """
+        downloader = PwnedPasswordsAPIv3(cache_size=1)
+        response = FakeResponse(headers={'ETag': self.ETAG}, content=self.BODY)
+        with mock.patch.object(
+            httpx.Client, 'request', return_value=response,
+        ) as mocked:
+            downloader.fetch_range_cached('5baa6')
+            downloader.fetch_range_cached('5baa7')
+            downloader.fetch_range_cached('5baa6')
+        self.assertEqual(mocked.call_count, 3)
+
+    def test_memory_stale_not_modified(self) -> None:
+        """
+        Stale range in memory revalidated using its ETag, and kept.
+        """
+        downloader = PwnedPasswordsAPIv3()
+        response = FakeResponse(headers={'ETag': self.ETAG}, content=self.BODY)
+        with mock.patch.object(httpx.Client, 'request', return_value=response):
+            first = downloader.fetch_range_cached('5baa6')
+
+        downloader.max_age = 0
+        response = FakeResponse(headers={'ETag': self.ETAG}, status_code=304)
+        with mock.patch.object(
+            httpx.Client, 'request', return_value=response,
+        ) as mocked:
+            second = downloader.fetch_range_cached('5baa6')
+        self.assertEqual(mocked.call_args.kwargs['headers'], {'If-None-Match': self.ETAG})
+        self.assertIs(first, second)
+
+    def test_memory_stale_on_disk(self) -> None:
+        """
+        Range in memory goes stale along with its entry on disk.
+        """
+        response = FakeResponse(headers={'ETag': self.ETAG}, content=self.BODY)
+        with mock.patch.object(httpx.Client, 'request', return_value=response):
+            first = self.downloader.fetch_range_cached('5baa6')
+
+        later = time.time() + self.cache.max_age + 1
+        response = FakeResponse(headers={'ETag': self.ETAG}, status_code=304)
+        with mock.patch.object(
+            httpx.Client, 'request', return_value=response,
+        ) as mocked, mock.patch('time.time', return_value=later):
+            second = self.downloader.fetch_range_cached('5baa6')
+        self.assertEqual(mocked.call_args.kwargs['headers'], {'If-None-Match': self.ETAG})
+        self.assertEqual(first, second)
+
+    def test_saved_to_disk(self) -> None:
+        response = FakeResponse(headers={'ETag': self.ETAG}, content=self.BODY)
+        with mock.patch.object(
+            httpx.Client, 'request', return_value=response,
+        ):
+            counts = self.downloader.fetch_range_cached('5BAA6')
+        self.assertEqual(counts, self.EXPECTED)
+        self.assertEqual(self.cache.get('5baa6'), (self.BODY, self.ETAG))
+
+    def test_fresh_on_disk(self) -> None:
+        self.cache.put('5baa6', self.BODY, self.ETAG)
+        with mock.patch.object(httpx.Client, 'request') as mocked:
+            counts = self.downloader.fetch_range_cached('5baa6')
+        mocked.assert_not_called()
+        self.assertEqual(counts, self.EXPECTED)
+
+    def test_stale_not_modified(self) -> None:
+        """
+        Stale entry revalidated using its ETag, and kept.
+        """
+        self.cache.put('5baa6', self.BODY, self.ETAG)
+        make_stale(self.cache, '5baa6')
+        response = FakeResponse(headers={'ETag': self.ETAG}, status_code=304)
+        with mock.patch.object(
+            httpx.Client, 'request', return_value=response,
+        ) as mocked:
+            counts = self.downloader.fetch_range_cached('5baa6')
+        self.assertEqual(mocked.call_args.kwargs['headers'], {'If-None-Match': self.ETAG})
+        self.assertEqual(counts, self.EXPECTED)
+        self.assertTrue(self.cache.is_fresh('5baa6'))
+
+    def test_stale_modified(self) -> None:
+        """
+        Stale entry replaced when its ETag no longer matches.
+        """
+        self.cache.put('5baa6', b'', self.ETAG)
+        make_stale(self.cache, '5baa6')
+        response = FakeResponse(headers={'ETag': '"0x8DC40B4A5D3E1F2"'}, content=self.BODY)
         with mock.patch.object(
-            self.downloader.session, 'request', return_value=response,
+            httpx.Client, 'request', return_value=response,
         ):
-            counts = self.downloader.fetch_range(prefix)
+            counts = self.downloader.fetch_range_cached('5baa6')
         self.assertEqual(counts, self.EXPECTED)
+        self.assertEqual(self.cache.get('5baa6'), (self.BODY, '"0x8DC40B4A5D3E1F2"'))
+
+
+class AsyncPwnedPasswordsAPIv3Test(IsolatedAsyncioTestCase):
+    BODY = PwnedPasswordsAPIv3Test.BODY
+    ETAG = PwnedPasswordsAPIv3Test.ETAG
+    EXPECTED = PwnedPasswordsAPIv3Test.EXPECTED
+
+    def setUp(self) -> None:
+        self.downloader = AsyncPwnedPasswordsAPIv3(max_requests=2)
+
+    async def asyncTearDown(self) -> None:
+        await self.downloader.close()
+
+    async def test_close_unopened(self) -> None:
+        self.assertIsNone(self.downloader.session)
+        await self.downloader.close()
+        self.assertIsNone(self.downloader.session)
+        self.assertIsNone(self.downloader.executor)
+
+    async def test_fetch_range(self) -> None:
+        """
+        Run API call using mocked response body.
+        """
+        return_value = (self.BODY, self.ETAG)
+        with mock.patch.object(self.downloader, '_get', return_value=return_value) as mocked:
+            counts, etag = await self.downloader.fetch_range('5BAA6')
+        mocked.assert_awaited_once_with('https://api.pwnedpasswords.com/range/5baa6', None)
+        self.assertEqual(counts, self.EXPECTED)
+        self.assertEqual(etag, self.ETAG)
+
+    async def test_fetch_range_workers(self) -> None:
+        """
+        Parse response in a worker process.
+        """
+        self.downloader = AsyncPwnedPasswordsAPIv3(max_requests=2, workers=1)
+        return_value = (self.BODY, self.ETAG)
+        with mock.patch.object(self.downloader, '_get', return_value=return_value):
+            counts, etag = await self.downloader.fetch_range('5BAA6')
+        self.assertIsNotNone(self.downloader.executor)
+        self.assertEqual(counts, self.EXPECTED)
+        self.assertEqual(etag, self.ETAG)
+
+        await self.downloader.close()
+        self.assertIsNone(self.downloader.executor)
+
+    async def test_fetch_range_not_modified(self) -> None:
+        return_value = (None, self.ETAG)
+        with mock.patch.object(self.downloader, '_get', return_value=return_value) as mocked:
+            counts, etag = await self.downloader.fetch_range('5baa6', etag=self.ETAG)
+        mocked.assert_awaited_once_with('https://api.pwnedpasswords.com/range/5baa6', self.ETAG)
+        self.assertIsNone(counts)
+        self.assertEqual(etag, self.ETAG)
+
+    async def test_fetch_range_concurrent(self) -> None:
+        return_value = (self.BODY, None)
+        with mock.patch.object(self.downloader, '_get', return_value=return_value) as mocked:
+            results = await asyncio.gather(
+                self.downloader.fetch_range('5baa6'),
+                self.downloader.fetch_range('5baa7'),
+            )
+        self.assertEqual(mocked.await_count, 2)
+        self.assertEqual(results[0], (self.EXPECTED, None))
+        hashes, _ = results[1]
+        assert hashes is not None
+        self.assertEqual(
+            hashes[0],
+            (bytes.fromhex('5baa7003cd215739d7c1b2218670d26f81408237'), 1),
+        )
+
+
+class AsyncPwnedPasswordsAPIv3ServerTest(IsolatedAsyncioTestCase):
+    """
+    Make real requests, to a local server standing in for the API.
+    """
+    BODY = PwnedPasswordsAPIv3Test.BODY
+    ETAG = PwnedPasswordsAPIv3Test.ETAG
+    EXPECTED = PwnedPasswordsAPIv3Test.EXPECTED
+
+    async def asyncSetUp(self) -> None:
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        app = web.Application()
+        app.router.add_get('/range/{prefix}', self.handle_range)
+        server = TestServer(app)
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+
+        self.downloader = AsyncPwnedPasswordsAPIv3(max_requests=2)
+        self.downloader.URL_RANGE = str(server.make_url('/range'))
+        self.addAsyncCleanup(self.downloader.close)
+
+    async def handle_range(self, request: web.Request) -> web.Response:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+
+        headers = {'ETag': self.ETAG}
+        if request.match_info['prefix'] == 'fffff':
+            return web.Response(status=500)
+        if request.headers.get('If-None-Match') == self.ETAG:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=self.BODY, headers=headers)
+
+    async def test_fetch_range(self) -> None:
+        counts, etag = await self.downloader.fetch_range('5baa6')
+        self.assertEqual(counts, self.EXPECTED)
+        self.assertEqual(etag, self.ETAG)
+        self.assertEqual(self.downloader.num_requests, 1)
+        self.assertEqual(self.downloader.bytes_received, len(self.BODY))
+
+    async def test_fetch_range_max_requests(self) -> None:
+        """
+        No more than `max_requests` are ever in-flight at once.
+        """
+        prefixes = [Prefix.from_integer(value) for value in range(6)]
+        results = await asyncio.gather(
+            *(self.downloader.fetch_range(prefix) for prefix in prefixes)
+        )
+        self.assertEqual(len(results), 6)
+        self.assertEqual(self.peak_in_flight, 2)
+
+    async def test_fetch_range_not_modified(self) -> None:
+        counts, etag = await self.downloader.fetch_range('5baa6', etag=self.ETAG)
+        self.assertIsNone(counts)
+        self.assertEqual(etag, self.ETAG)
+        self.assertEqual(self.downloader.bytes_received, 0)
+
+    async def test_fetch_range_server_error(self) -> None:
+        with self.assertRaises(aiohttp.ClientResponseError) as context:
+            await self.downloader.fetch_range('fffff')
+        self.assertEqual(context.exception.status, 500)
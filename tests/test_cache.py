@@ -0,0 +1,89 @@
+
+from pathlib import Path
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+from unittest import TestCase
+
+from pwneddb.cache import RangeCache
+
+from .base import make_stale
+
+
+class RangeCacheTest(TestCase):
+    BODY = (
+        b'003CD215739D7C1B2218670D26F81408237:1\r\n'
+        b'003D68EB55068C33ACE09247EE4C639306B:4\r\n'
+    )
+    ETAG = '"0x8DC3F1B9E3A2C41"'
+
+    def setUp(self) -> None:
+        self.temp_folder = TemporaryDirectory()
+        self.addCleanup(self.temp_folder.cleanup)
+        self.folder = Path(self.temp_folder.name) / 'cache'
+        self.cache = RangeCache(self.folder)
+
+    def test_create_folder(self) -> None:
+        self.assertTrue(self.folder.is_dir())
+
+    def test_get_missing(self) -> None:
+        self.assertIsNone(self.cache.get('5baa6'))
+        self.assertFalse(self.cache.is_fresh('5baa6'))
+        self.assertIsNone(self.cache.modified('5baa6'))
+
+    def test_import_without_zstandard(self) -> None:
+        """
+        Zstandard is only needed once a cache is created, not to import us.
+        """
+        code = (
+            "import sys; sys.modules['zstandard'] = None; "
+            "import pwneddb.command_line; "
+            "from pwneddb.cache import RangeCache; print(RangeCache.MAX_AGE)"
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, check=True, text=True,
+        )
+        self.assertEqual(result.stdout, '86400\n')
+
+    def test_path(self) -> None:
+        self.assertEqual(self.cache.path('5baa6'), self.folder / '5baa6.zst')
+
+    def test_put(self) -> None:
+        before = time.time()
+        self.cache.put('5baa6', self.BODY, self.ETAG)
+        self.assertEqual(self.cache.get('5baa6'), (self.BODY, self.ETAG))
+        self.assertTrue(self.cache.is_fresh('5baa6'))
+        modified = self.cache.modified('5baa6')
+        assert modified is not None
+        self.assertGreaterEqual(modified, before - 1)
+        self.assertEqual(list(self.folder.iterdir()), [self.folder / '5baa6.zst'])
+
+    def test_put_compressed(self) -> None:
+        body = self.BODY * 100
+        self.cache.put('5baa6', body, self.ETAG)
+        self.assertLess(self.cache.path('5baa6').stat().st_size, len(body) / 10)
+
+    def test_put_no_etag(self) -> None:
+        self.cache.put('5baa6', self.BODY, None)
+        self.assertEqual(self.cache.get('5baa6'), (self.BODY, None))
+
+    def test_put_replace(self) -> None:
+        self.cache.put('5baa6', self.BODY, self.ETAG)
+        self.cache.put('5baa6', b'', '"0x8DC40B4A5D3E1F2"')
+        self.assertEqual(self.cache.get('5baa6'), (b'', '"0x8DC40B4A5D3E1F2"'))
+
+    def test_stale(self) -> None:
+        """
+        Stale entries are still returned, but are no longer fresh.
+        """
+        self.cache.put('5baa6', self.BODY, self.ETAG)
+        make_stale(self.cache, '5baa6')
+        self.assertFalse(self.cache.is_fresh('5baa6'))
+        self.assertEqual(self.cache.get('5baa6'), (self.BODY, self.ETAG))
+
+    def test_touch(self) -> None:
+        self.cache.put('5baa6', self.BODY, self.ETAG)
+        make_stale(self.cache, '5baa6')
+        self.cache.touch('5baa6')
+        self.assertTrue(self.cache.is_fresh('5baa6'))
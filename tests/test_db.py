@@ -1,17 +1,28 @@
 
 from datetime import datetime
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from unittest import TestCase
+import shutil
+import tempfile
+from types import MappingProxyType
+from typing import Any, Optional
+from unittest import mock, TestCase
 
-from sqlalchemy import inspect, select
+from sqlalchemy import create_engine, event, inspect, select, text
 from sqlalchemy.engine.base import Engine as SQLAlchemyEngine
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.session import Session as SQLAlchemySession
 
-from pwneddb.db import connect, Password, Prefix
+from pwneddb.db import (
+    Base,
+    connect,
+    Password,
+    Prefix,
+    PrefixManager,
+    set_sqlite_pragma,
+    set_sqlite_pragma_not_durable,
+)
 
-from .base import logger_hush, TransactionTestCase
+from .base import ENGINE, logger_hush, seed, TransactionTestCase
 
 
 def get_table_names(session: SQLAlchemySession) -> list[str]:
@@ -22,81 +33,137 @@ def get_table_names(session: SQLAlchemySession) -> list[str]:
 
 
 class ConnectTest(TestCase):
-    temp_folder: TemporaryDirectory[str]
+    temp_folder: Path
 
     @classmethod
     def setUpClass(cls) -> None:
-        cls.temp_folder = TemporaryDirectory()
+        cls.temp_folder = Path(tempfile.mkdtemp(prefix='pwneddb-'))
+        cls.addClassCleanup(shutil.rmtree, cls.temp_folder, ignore_errors=True)
 
-    @classmethod
-    def tearDownClass(cls) -> None:
-        cls.temp_folder.cleanup()
+    def connect(self, path: Optional[Path] = None, **kwargs: Any) -> SQLAlchemySession:
+        """
+        Connect to database, closing session and disposing engine after test.
+        """
+        session = connect(path, **kwargs)
+        assert isinstance(session.bind, SQLAlchemyEngine)
+        self.addCleanup(session.bind.dispose)
+        self.addCleanup(session.close)
+        return session
 
     def path_name(self, file_name: str) -> Path:
         """
-        Build path inside test class's temporary folder.
+        Build path inside test class's temporary folder, deleted after test.
         """
-        path = Path(self.temp_folder.name) / file_name
+        path = self.temp_folder / file_name
+        self.addCleanup(path.unlink, missing_ok=True)
         return path
 
     def test_connect_default(self) -> None:
-        session = connect()
+        session = self.connect()
         assert isinstance(session, SQLAlchemySession)
         assert isinstance(session.bind, SQLAlchemyEngine)
         self.assertEqual(session.bind.url.drivername, 'sqlite+pysqlite')
         self.assertEqual(session.bind.url.database, ':memory:')
 
+    def test_connect_engine(self) -> None:
+        """
+        Given engine is used as-is, without our PRAGMAs.
+        """
+        session = connect(engine=ENGINE)
+        self.addCleanup(session.close)
+        self.assertIs(session.bind, ENGINE)
+        self.assertFalse(event.contains(ENGINE, 'connect', set_sqlite_pragma))
+        self.assertEqual(get_table_names(session), ['passwords', 'prefixes'])
+
+    def test_connect_engine_tables_created_once(self) -> None:
+        engine = create_engine('sqlite+pysqlite:///:memory:')
+        self.addCleanup(engine.dispose)
+        with mock.patch.object(
+            Base.metadata, 'create_all', wraps=Base.metadata.create_all,
+        ) as create_all:
+            connect(engine=engine).close()
+            connect(engine=engine).close()
+        create_all.assert_called_once_with(engine)
+
+    def test_connect_pragmas(self) -> None:
+        """
+        PRAGMAs listener is attached to the new engine only, not all engines.
+        """
+        session = self.connect()
+        assert isinstance(session.bind, SQLAlchemyEngine)
+        self.assertTrue(event.contains(session.bind, 'connect', set_sqlite_pragma))
+        self.assertFalse(event.contains(SQLAlchemyEngine, 'connect', set_sqlite_pragma))
+        foreign_keys = session.scalar(text('PRAGMA foreign_keys;'))
+        self.assertEqual(foreign_keys, 1)
+
+    def test_connect_not_durable(self) -> None:
+        path = self.path_name('not_durable.db')
+        with logger_hush():
+            session = self.connect(path, durable=False)
+        assert isinstance(session.bind, SQLAlchemyEngine)
+        self.assertTrue(event.contains(session.bind, 'connect', set_sqlite_pragma))
+        self.assertTrue(event.contains(session.bind, 'connect', set_sqlite_pragma_not_durable))
+        self.assertEqual(session.scalar(text('PRAGMA journal_mode;')), 'memory')
+        self.assertEqual(session.scalar(text('PRAGMA synchronous;')), 0)
+
+    def test_connect_durable(self) -> None:
+        path = self.path_name('durable.db')
+        with logger_hush():
+            session = self.connect(path)
+        assert isinstance(session.bind, SQLAlchemyEngine)
+        self.assertFalse(
+            event.contains(session.bind, 'connect', set_sqlite_pragma_not_durable)
+        )
+        self.assertEqual(session.scalar(text('PRAGMA journal_mode;')), 'wal')
+        self.assertEqual(session.scalar(text('PRAGMA synchronous;')), 1)
+
     def test_connect_create_file(self) -> None:
         path = self.path_name('passwords.db')
 
         # Suppress 'cretae new database' warning log message
         with logger_hush():
-            session = connect(path)
-
-        try:
-            assert isinstance(session, SQLAlchemySession)
-            assert isinstance(session.bind, SQLAlchemyEngine)
-            self.assertEqual(session.bind.url.drivername, 'sqlite+pysqlite')
-            assert session.bind.url.database is not None
-            self.assertTrue(session.bind.url.database.endswith(path.name))
-            self.assertEqual(get_table_names(session), ['passwords', 'prefixes'])
-        finally:
-            session.close()
+            session = self.connect(path)
+
+        assert isinstance(session, SQLAlchemySession)
+        assert isinstance(session.bind, SQLAlchemyEngine)
+        self.assertEqual(session.bind.url.drivername, 'sqlite+pysqlite')
+        assert session.bind.url.database is not None
+        self.assertTrue(session.bind.url.database.endswith(path.name))
+        self.assertEqual(get_table_names(session), ['passwords', 'prefixes'])
 
     def test_connect_existing_file(self) -> None:
         # Create existing
         path = self.path_name('existing.db')
         path.touch()
 
-        session = connect(path)
-        try:
-            assert isinstance(session, SQLAlchemySession)
-            assert isinstance(session.bind, SQLAlchemyEngine)
-            self.assertEqual(session.bind.url.drivername, 'sqlite+pysqlite')
-            assert session.bind.url.database is not None
-            self.assertTrue(session.bind.url.database.endswith(path.name))
-            self.assertEqual(get_table_names(session), ['passwords', 'prefixes'])
-        finally:
-            session.close()
+        session = self.connect(path)
+        assert isinstance(session, SQLAlchemySession)
+        assert isinstance(session.bind, SQLAlchemyEngine)
+        self.assertEqual(session.bind.url.drivername, 'sqlite+pysqlite')
+        assert session.bind.url.database is not None
+        self.assertTrue(session.bind.url.database.endswith(path.name))
+        self.assertEqual(get_table_names(session), ['passwords', 'prefixes'])
 
 
 class PasswordTest(TransactionTestCase):
     """
     Test ``Password`` database model.
     """
-    PASSWORD = {
-        'sha1': "c8fed00eb2e87f1cee8e90ebbe870c190ac3848c",
+    PASSWORD: MappingProxyType[str, Any] = MappingProxyType({
+        'sha1': bytes.fromhex("c8fed00eb2e87f1cee8e90ebbe870c190ac3848c"),
         'password': "password",
         'count': 9_659_365,
         'prefix_id': 1,
-    }
+    })
+    EXPECTED_REPR = "<Password: c8fed00eb2e87f1cee8e90ebbe870c190ac3848c ('password') 9,659,365>"
 
     def test_repr(self) -> None:
         password = Password(**self.PASSWORD)
-        self.assertEqual(
-            repr(password),
-            "<Password: c8fed00eb2e87f1cee8e90ebbe870c190ac3848c ('password') 9,659,365>",
-        )
+        self.assertEqual(repr(password), self.EXPECTED_REPR)
+
+    def test_sha1_hex(self) -> None:
+        password = Password(**self.PASSWORD)
+        self.assertEqual(password.sha1_hex, "c8fed00eb2e87f1cee8e90ebbe870c190ac3848c")
 
     def test_add(self) -> None:
         # Prepare
@@ -113,14 +180,41 @@ class PasswordTest(TransactionTestCase):
         # Check state
         self.assertEqual(password.id, 1)
         self.assertEqual(manager.count_rows(), 1)
-        self.assertEqual(
-            repr(password),
-            "<Password: c8fed00eb2e87f1cee8e90ebbe870c190ac3848c ('password') 9,659,365>",
-        )
+        self.assertEqual(repr(password), self.EXPECTED_REPR)
 
 
 class PasswordManagerTest(TransactionTestCase):
-    pass
+    def setUp(self) -> None:
+        super().setUp()
+        self.manager = Password.objects(self.session)
+
+    def test_insert_hashes(self) -> None:
+        prefix = Prefix(prefix='5baa6')
+        self.session.add(prefix)
+        self.session.flush()
+
+        inserted = self.manager.insert_hashes(prefix.id, [
+            (bytes.fromhex('5baa6003cd215739d7c1b2218670d26f81408237'), 1),
+            (bytes.fromhex('5baa6003d68eb55068c33ace09247ee4c639306b'), 4),
+        ])
+        self.session.commit()
+
+        self.assertEqual(inserted, 2)
+        self.assertEqual(self.manager.count_rows(), 2)
+        self.assertEqual(
+            [(password.sha1, password.count) for password in prefix.passwords],
+            [
+                (bytes.fromhex('5baa6003cd215739d7c1b2218670d26f81408237'), 1),
+                (bytes.fromhex('5baa6003d68eb55068c33ace09247ee4c639306b'), 4),
+            ],
+        )
+
+    def test_insert_hashes_empty(self) -> None:
+        prefix = Prefix(prefix='5baa6')
+        self.session.add(prefix)
+        self.session.flush()
+        self.assertEqual(self.manager.insert_hashes(prefix.id, []), 0)
+        self.assertEqual(self.manager.count_rows(), 0)
 
 
 class PrefixTest(TransactionTestCase):
@@ -188,47 +282,152 @@ class PrefixTest(TransactionTestCase):
         with self.assertRaisesRegex(ValueError, message):
             Prefix(prefix='abcd')
 
+    def test_add_not_hexadecimal(self) -> None:
+        message = r"^Given prefix not hexadecimal: 'abcdg'$"
+        with self.assertRaisesRegex(ValueError, message):
+            Prefix(prefix='abcdg')
+
 
 class PrefixManagerTest(TransactionTestCase):
     def setUp(self) -> None:
         super().setUp()
         self.manager = Prefix.objects(self.session)
 
+    def test_add_all(self) -> None:
+        self.manager.add_all([
+            Prefix(prefix='000AF'),
+            Prefix(prefix='000b1', updated=1681081900.0, etag='"0x8DC3F1B9E3A2C41"'),
+        ])
+        prefixes = self.session.scalars(select(Prefix).order_by(Prefix.prefix)).all()
+        self.assertEqual([prefix.prefix for prefix in prefixes], ['000af', '000b1'])
+        self.assertIsNotNone(prefixes[0].updated)
+        self.assertIsNone(prefixes[0].etag)
+        self.assertEqual(prefixes[1].updated, 1681081900.0)
+        self.assertEqual(prefixes[1].etag, '"0x8DC3F1B9E3A2C41"')
+
+    def test_add_all_empty(self) -> None:
+        self.manager.add_all([])
+        self.assertEqual(self.manager.count_rows(), 0)
+
+    def test_add_all_not_prefix(self) -> None:
+        password = Password(**PasswordTest.PASSWORD)
+        message = r"^Expected Prefix instance, not: <Password: c8fed00e"
+        with self.assertRaisesRegex(TypeError, message):
+            self.manager.add_all([Prefix(prefix='abcde'), password])
+        self.assertEqual(self.manager.count_rows(), 0)
+
+    def test_add_all_stay_transient(self) -> None:
+        prefix = Prefix(prefix='abcde')
+        self.manager.add_all([prefix])
+        self.assertTrue(inspect(prefix).transient)
+        self.assertIsNone(prefix.id)
+
+    def test_add_all_with_passwords(self) -> None:
+        """
+        Prefixes with passwords are added via the ORM, passwords and all.
+        """
+        password = Password(**{**PasswordTest.PASSWORD, 'prefix_id': None})
+        prefix = Prefix(prefix='abcde', passwords=[password])
+        self.manager.add_all([prefix, Prefix(prefix='bcdef')])
+        self.assertIsNotNone(prefix.id)
+        self.assertEqual(self.manager.count_rows(), 2)
+        self.assertEqual(Password.objects(self.session).count_rows(), 1)
+        self.assertEqual(password.prefix_id, prefix.id)
+
+    def test_count_complete(self) -> None:
+        seed(self.session)
+        self.assertEqual(self.manager.count_complete(), 0)
+        self.manager.mark_updated('00003', None)
+        self.manager.mark_updated('0000a', None)
+        self.assertEqual(self.manager.count_complete(), 2)
+        self.assertEqual(self.manager.count_rows(), 16)
+
     def test_find_missing(self) -> None:
         """
-        One bigger than the largest
+        Smallest prefix not yet downloaded.
         """
-        self.manager.add_all([
-            Prefix(prefix='000af'),
-            Prefix(prefix='000b1'),
-            Prefix(prefix='000b0'),
-            Prefix(prefix='000ae'),
-        ])
-        self.assertEqual(self.manager.find_missing(), '000b2')
+        seed(self.session)
+        self.manager.mark_updated('00000', None)
+        self.manager.mark_updated('00001', None)
+        self.manager.mark_updated('00003', None)
+        self.assertEqual(self.manager.find_missing(), '00002')
 
     def test_find_missing_empty(self) -> None:
         """
-        Empty database? The first missing is the first possible.
+        Nothing seeded? Nothing to find.
+        """
+        self.assertEqual(self.manager.find_missing(), None)
+
+    def test_find_missing_seeded(self) -> None:
+        """
+        Freshly seeded database? The first missing is the first possible.
         """
+        seed(self.session)
         missing = self.manager.find_missing()
         self.assertEqual(missing, '00000')
-        self.manager.add(Prefix(prefix=missing))
+        assert missing is not None
+        self.manager.mark_updated(missing, None)
 
         missing = self.manager.find_missing()
         self.assertEqual(missing, '00001')
 
     def test_find_missing_full(self) -> None:
         """
-        Largest already the last? Prefix table must be full, right? ;-)
+        Every prefix downloaded? Prefix table must be full, right? ;-)
         """
-        self.manager.add(Prefix(prefix='ffffe'))
+        seed(self.session, total_rows=2)
+        self.manager.mark_updated('00000', None)
         missing = self.manager.find_missing()
-        self.assertEqual(missing, 'fffff')
+        self.assertEqual(missing, '00001')
 
-        self.manager.add(Prefix(prefix=missing))
+        assert missing is not None
+        self.manager.mark_updated(missing, None)
         missing = self.manager.find_missing()
         self.assertEqual(missing, None)
 
+    def test_find_missing_many(self) -> None:
+        seed(self.session)
+        self.manager.mark_updated('00001', None)
+        self.assertEqual(
+            self.manager.find_missing_many(3),
+            ['00000', '00002', '00003'],
+        )
+
+    def test_find_missing_many_query_plan(self) -> None:
+        """
+        Missing prefixes are read in order from the index alone, no sorting.
+        """
+        executed: list[tuple[str, Any]] = []
+
+        def record(conn: Any, cursor: Any, statement: str, parameters: Any,
+                   context: Any, executemany: bool) -> None:
+            if statement.startswith('SELECT'):
+                executed.append((statement, parameters))
+
+        event.listen(self.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute', record)
+        self.manager.find_missing_many(64)
+        self.assertEqual(len(executed), 1)
+
+        statement, parameters = executed[0]
+        connection = self.session.connection()
+        plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+        details = [row.detail for row in plan]
+        self.assertTrue(
+            any('ix_prefixes_updated_prefix' in detail for detail in details), details,
+        )
+        self.assertFalse(any('USE TEMP B-TREE' in detail for detail in details), details)
+
+    def test_find_missing_many_nearly_full(self) -> None:
+        seed(self.session, total_rows=4)
+        self.manager.mark_updated('00000', None)
+        self.manager.mark_updated('00001', None)
+        self.assertEqual(self.manager.find_missing_many(64), ['00002', '00003'])
+
+        self.manager.mark_updated('00002', None)
+        self.manager.mark_updated('00003', None)
+        self.assertEqual(self.manager.find_missing_many(64), [])
+
     def test_largest_prefix(self) -> None:
         """The largest alphanumerically and arithmetically"""
         self.manager.add_all([
@@ -245,6 +444,49 @@ class PrefixManagerTest(TransactionTestCase):
         """
         self.assertEqual(self.manager.largest_prefix(), None)
 
+    def test_largest_prefix_not_downloaded(self) -> None:
+        """
+        Prefixes not yet downloaded are ignored.
+        """
+        seed(self.session)
+        self.assertEqual(self.manager.largest_prefix(), None)
+        self.manager.mark_updated('00004', None)
+        self.assertEqual(self.manager.largest_prefix(), '00004')
+
+    def test_mark_updated(self) -> None:
+        seed(self.session)
+        prefix = self.session.scalars(select(Prefix).where(Prefix.prefix == '0000c')).one()
+        self.assertIsNone(prefix.updated)
+
+        prefix_id = self.manager.mark_updated('0000C', '"0x8DC3F1B9E3A2C41"')
+        self.session.refresh(prefix)
+        self.assertEqual(prefix_id, prefix.id)
+        self.assertIsInstance(prefix.get_updated(), datetime)
+        self.assertEqual(prefix.etag, '"0x8DC3F1B9E3A2C41"')
+        self.assertEqual(self.manager.count_rows(), 16)
+
+    def test_mark_updated_create(self) -> None:
+        """
+        Prefix record is created if it was somehow missing.
+        """
+        prefix_id = self.manager.mark_updated('abcde', None)
+        prefix = self.session.get(Prefix, prefix_id)
+        assert prefix is not None
+        self.assertEqual(prefix.prefix, 'abcde')
+        self.assertIsInstance(prefix.get_updated(), datetime)
+
+    def test_oldest(self) -> None:
+        seed(self.session)
+        self.session.add(Prefix(prefix='abcde', updated=1681081917.208))
+        self.session.add(Prefix(prefix='bcdef', updated=1681081900.0))
+        oldest = self.manager.oldest()
+        assert oldest is not None
+        self.assertEqual(oldest.prefix, 'bcdef')
+
+    def test_oldest_none_downloaded(self) -> None:
+        seed(self.session)
+        self.assertIsNone(self.manager.oldest())
+
     def test_percent_completed_empty(self) -> None:
         self.assertEqual(self.manager.percentage_complete(), 0.0)
 
@@ -252,6 +494,31 @@ class PrefixManagerTest(TransactionTestCase):
         self.manager.add(Prefix(prefix='00000'))
         self.assertAlmostEqual(self.manager.percentage_complete(), (1 / 2**20) * 100)
 
+    def test_percent_completed_given(self) -> None:
+        self.assertAlmostEqual(self.manager.percentage_complete(2**19), 50)
+
     def test_percent_completed_full(self) -> None:
-        self.manager.add(Prefix(prefix='fffff'))
-        self.assertAlmostEqual(self.manager.percentage_complete(), 100)
+        with mock.patch.multiple(PrefixManager, TOTAL_ROWS=16, PERCENT_PER_ROW=100 / 16):
+            self.manager.seed()
+            for missing in self.manager.find_missing_many(16):
+                self.manager.mark_updated(missing, None)
+            self.assertAlmostEqual(self.manager.percentage_complete(), 100)
+
+    def test_seed(self) -> None:
+        seed(self.session)
+        prefixes = list(self.session.scalars(select(Prefix)))
+        self.assertEqual(len(prefixes), 16)
+        self.assertEqual(prefixes[0].prefix, '00000')
+        self.assertEqual(prefixes[-1].prefix, '0000f')
+        self.assertEqual({prefix.updated for prefix in prefixes}, {None})
+
+    def test_seed_partial(self) -> None:
+        """
+        Existing prefixes are kept, along with their update times.
+        """
+        self.manager.add(Prefix(prefix='00004', updated=1681081917.208))
+        with mock.patch.object(PrefixManager, 'TOTAL_ROWS', 16):
+            self.assertEqual(self.manager.seed(), 15)
+            self.assertEqual(self.manager.seed(), 0)
+        self.assertEqual(self.manager.count_rows(), 16)
+        self.assertEqual(self.manager.count_complete(), 1)
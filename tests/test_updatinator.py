@@ -1,47 +1,210 @@
+import asyncio
+from typing import Optional
+from unittest import mock
 
-from unittest import mock, TestCase
-
+import httpx
+from sqlalchemy import update
 from sqlalchemy.orm.session import Session as SQLAlchemySession
 
 from pwneddb import db, updatinator
 
-from .base import FakeResponse, logger_hush
+from .base import AsyncTransactionTestCase, FakeResponse, logger_hush, seed, TransactionTestCase
 
 
 RESPONSE = (
-    '003CD215739D7C1B2218670D26F81408237:1\r\n'
-    '003D68EB55068C33ACE09247EE4C639306B:4\r\n'
-    '012C192B2F16F82EA0EB9EF18D9D539B0DD:3\r\n'
-    '01330C689E5D64F660D6947A93AD634EF8F:0\r\n'
+    b'003CD215739D7C1B2218670D26F81408237:1\r\n'
+    b'003D68EB55068C33ACE09247EE4C639306B:4\r\n'
+    b'012C192B2F16F82EA0EB9EF18D9D539B0DD:3\r\n'
+    b'01330C689E5D64F660D6947A93AD634EF8F:0\r\n'
+)
+RESPONSE_NEW = (
+    b'003CD215739D7C1B2218670D26F81408237:7\r\n'
+    b'003D68EB55068C33ACE09247EE4C639306B:4\r\n'
 )
+ETAG = '"0x8DC3F1B9E3A2C41"'
 
 
 def count_records(session: SQLAlchemySession) -> tuple[int, int]:
-    num_prefixes = db.PrefixManager(session).count_rows()
+    """
+    Count downloaded prefixes, and passwords.
+    """
+    num_prefixes = db.PrefixManager(session).count_complete()
     num_passwords = db.PasswordManager(session).count_rows()
     return (num_prefixes, num_passwords)
 
 
-class UpdatinatorTest(TestCase):
+class UpdatinatorTest(TransactionTestCase):
+    request: mock.MagicMock
     updater: updatinator.Updatinator
 
+    @classmethod
+    def setUpClass(cls) -> None:
+        """
+        Patch HTTP requests once for the whole class, so no test reaches the API.
+        """
+        super().setUpClass()
+        patcher = mock.patch.object(httpx.Client, 'request')
+        cls.request = patcher.start()
+        cls.addClassCleanup(patcher.stop)
+
     def setUp(self) -> None:
-        self.session = db.connect()
+        super().setUp()
+        self.request.reset_mock(return_value=True, side_effect=True)
+        self.request.return_value = FakeResponse(content=RESPONSE)
+        seed(self.session)
         self.updater = updatinator.Updatinator(self.session)
 
     def test_create_new(self) -> None:
         self.assertEqual(count_records(self.session), (0, 0))
 
-        response = FakeResponse(text=RESPONSE)
-        with mock.patch.object(
-            self.updater.api.session, 'request', return_value=response,
-        ):
-            self.updater.create_new()
+        self.updater.create_new()
 
         self.assertEqual(count_records(self.session), (1, 4))
 
     def test_create_new_full(self) -> None:
-        self.session.add(db.Prefix(prefix='fffff'))
+        self.session.execute(update(db.Prefix).values(updated=1681081917.208))
         message = r"^No missing prefixes found$"
         with self.assertRaisesRegex(RuntimeError, message), logger_hush():
             self.updater.create_new()
+
+    def test_create_new_batch(self) -> None:
+        with mock.patch.object(
+            self.session, 'commit', wraps=self.session.commit,
+        ) as commit:
+            created = self.updater.create_new_batch(3)
+
+        commit.assert_called_once()
+        self.assertEqual(created, [('00000', 4), ('00001', 4), ('00002', 4)])
+        self.assertEqual(count_records(self.session), (3, 12))
+
+    def test_percentage_complete_cached(self) -> None:
+        """
+        Downloaded prefixes are only counted by the database on cold start.
+        """
+        with mock.patch.object(
+            self.updater.prefixes, 'count_complete', wraps=self.updater.prefixes.count_complete,
+        ) as count_complete:
+            self.updater.create_new_batch(2)
+            self.assertAlmostEqual(self.updater.percentage_complete(), (2 / 2**20) * 100)
+            self.updater.create_new_batch(2)
+            self.assertAlmostEqual(self.updater.percentage_complete(), (4 / 2**20) * 100)
+
+        count_complete.assert_called_once()
+        self.assertEqual(self.updater.prefixes.find_missing_many(2), ['00004', '00005'])
+        self.assertEqual(count_records(self.session), (4, 16))
+
+    def test_create_new_batch_exit(self) -> None:
+        """
+        Prefixes downloaded before being asked to exit are still saved.
+        """
+        hashes = [(bytes.fromhex('00000003cd215739d7c1b2218670d26f81408237'), 1)]
+        with mock.patch.object(
+            self.updater.api, 'fetch_range',
+            side_effect=[(hashes, None), (hashes, None), SystemExit('Cancelled')],
+        ), self.assertRaises(SystemExit):
+            self.updater.create_new_batch(3)
+
+        self.session.rollback()
+        self.assertEqual(count_records(self.session), (2, 2))
+
+    def test_create_new_etag(self) -> None:
+        self.request.return_value = FakeResponse(headers={'ETag': ETAG}, content=RESPONSE)
+        self.updater.create_new()
+
+        prefix = self.updater.prefixes.oldest()
+        assert prefix is not None
+        self.assertEqual(prefix.etag, ETAG)
+
+    def test_update_existing_empty(self) -> None:
+        message = r"^No existing prefixes found$"
+        with self.assertRaisesRegex(RuntimeError, message), logger_hush():
+            self.updater.update_existing()
+
+    def test_update_existing_not_modified(self) -> None:
+        self.session.add(db.Prefix(prefix='abcde', updated=1681081917.208, etag=ETAG))
+        self.session.add(db.Prefix(prefix='bcdef'))
+        self.session.commit()
+
+        self.request.return_value = FakeResponse(headers={'ETag': ETAG}, status_code=304)
+        updated = self.updater.update_existing()
+
+        self.assertEqual(self.request.call_args.kwargs['headers'], {'If-None-Match': ETAG})
+        self.assertEqual(updated, ('abcde', None))
+        self.assertEqual(count_records(self.session), (2, 0))
+        prefix = self.updater.prefixes.oldest()
+        assert prefix is not None
+        self.assertEqual(prefix.prefix, 'bcdef')
+
+    def test_update_existing_modified(self) -> None:
+        old = db.Password(
+            sha1=bytes.fromhex('abcde003cd215739d7c1b2218670d26f81408237'),
+            password='hunter2',
+            count=1,
+        )
+        self.session.add(db.Prefix(prefix='abcde', etag=ETAG, passwords=[old]))
+        self.session.commit()
+
+        self.request.return_value = FakeResponse(
+            headers={'ETag': '"0x8DC40B4A5D3E1F2"'}, content=RESPONSE_NEW,
+        )
+        updated = self.updater.update_existing()
+
+        self.assertEqual(updated, ('abcde', 2))
+        self.assertEqual(count_records(self.session), (1, 2))
+        self.assertEqual(old.count, 7)
+        self.assertEqual(old.password, 'hunter2')
+        self.assertEqual(old.prefix.etag, '"0x8DC40B4A5D3E1F2"')
+
+
+class UpdatinatorAsyncTest(AsyncTransactionTestCase):
+    updater: updatinator.Updatinator
+
+    def setUp(self) -> None:
+        super().setUp()
+        seed(self.session)
+        self.updater = updatinator.Updatinator(self.session, concurrency=2)
+
+    async def asyncTearDown(self) -> None:
+        await self.updater.async_api.close()
+
+    async def test_create_many(self) -> None:
+        self.assertEqual(count_records(self.session), (0, 0))
+
+        prefixes = self.updater.prefixes.find_missing_many(3)
+        with mock.patch.object(
+            self.updater.async_api, '_get', return_value=(RESPONSE, None),
+        ):
+            created = await self.updater.create_many(prefixes)
+
+        self.assertEqual(created, [('00000', 4), ('00001', 4), ('00002', 4)])
+        self.assertEqual(count_records(self.session), (3, 12))
+        self.assertEqual(self.updater.prefixes.find_missing(), '00003')
+
+    async def test_create_many_interrupted(self) -> None:
+        """
+        Downloads finished before being interrupted can still be saved.
+        """
+        forever = asyncio.Event()
+
+        async def get(url: str, etag: Optional[str] = None) -> tuple[bytes, None]:
+            if not url.endswith('00000'):
+                await forever.wait()
+            return RESPONSE, None
+
+        prefixes = self.updater.prefixes.find_missing_many(3)
+        with mock.patch.object(self.updater.async_api, '_get', side_effect=get):
+            task = asyncio.create_task(self.updater.create_many(prefixes))
+            while not self.updater._downloaded:
+                await asyncio.sleep(0)
+
+            # As per `asyncio.run()`, when a signal handler raises SystemExit
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.assertEqual(count_records(self.session), (0, 0))
+
+        created = self.updater.save_downloaded()
+        self.assertEqual(created, [('00000', 4)])
+        self.assertEqual(count_records(self.session), (1, 4))
+        self.assertEqual(self.updater.prefixes.find_missing(), '00001')
+        self.assertEqual(self.updater.save_downloaded(), [])